@@ -0,0 +1,268 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, where peak RSS is not recorded
+    resource = None
+
+BENCHMARKS = ('create_vmat_files', 'scale_images_in_directory', 'find_texture_sets',
+              'create_subdirectories_with_files', 'traverse_and_generate_models')
+DEFAULT_SIZES = (100, 1000, 5000)
+
+
+def generate_textures(directory, count, seed=0):
+    """
+    Generate 16x16 Minecraft-style textures, a mix of opaque, cutout and translucent ones, below tex/ folders.
+
+    :param directory: The directory to generate the textures in.
+    :param count: The number of textures.
+    :param seed: The seed making the corpus reproducible.
+    """
+    from PIL import Image
+    rng = random.Random(seed)
+    for index in range(count):
+        folder = os.path.join(directory, 'tex', 'minecraft', ('block', 'item', 'entity')[index % 3])
+        os.makedirs(folder, exist_ok=True)
+        kind = index % 4
+        pixels = []
+        for _ in range(16 * 16):
+            color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            if kind == 0:
+                alpha = 255
+            elif kind == 1:
+                alpha = rng.choice((0, 255))
+            elif kind == 2:
+                alpha = rng.randrange(256)
+            else:
+                color, alpha = (0, 0, 0), rng.choice((0, 128))
+            pixels.append(color + (alpha,))
+        img = Image.new('RGBA', (16, 16))
+        img.putdata(pixels)
+        img.save(os.path.join(folder, f'texture_{index}.png'))
+
+
+def generate_texture_sets(directory, count, seed=0):
+    """
+    Generate PBR texture sets, each a *.texture_set.json with a color and a metalness_emissive_roughness texture.
+
+    :param directory: The directory to generate the texture sets in.
+    :param count: The number of texture sets.
+    :param seed: The seed making the corpus reproducible.
+    """
+    from PIL import Image
+    generate_textures(directory, count, seed)
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.endswith('.png'):
+                name = os.path.splitext(file)[0]
+                Image.new('RGB', (16, 16), (0, 128, 255)).save(os.path.join(root, f'{name}_mer.png'))
+                with open(os.path.join(root, f'{name}.texture_set.json'), 'w') as json_file:
+                    json.dump({"format_version": "1.16.100",
+                               "minecraft:texture_set": {"color": name, "metalness_emissive_roughness": f'{name}_mer'}},
+                              json_file)
+
+
+def generate_fbx_files(directory, count, seed=0, files_per_folder=None):
+    """
+    Generate dummy .fbx files of varying size below csgo_addons/bench/models/details/fbx.
+
+    :param directory: The directory to generate the files in.
+    :param count: The number of .fbx files.
+    :param seed: The seed making the corpus reproducible.
+    :param files_per_folder: Spread the files over numbered subdirectories of this many files, or put them all in
+                             one directory if None.
+    :return: The directory containing the .fbx files or their subdirectories.
+    """
+    rng = random.Random(seed)
+    fbx_directory = os.path.join(directory, 'csgo_addons', 'bench', 'models', 'details', 'fbx')
+    for index in range(count):
+        folder = fbx_directory
+        if files_per_folder:
+            folder = os.path.join(fbx_directory, str(index // files_per_folder + 1))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f'chunk_{index}.fbx'), 'wb') as fbx_file:
+            fbx_file.write(b'Kaydara FBX Binary  \x00' + rng.randbytes(rng.randrange(64, 4096)))
+    return fbx_directory
+
+
+def _prepare(name, directory, size, workers):
+    """Generate the corpus of a benchmark and return the function running it."""
+    if name == 'create_vmat_files':
+        from vmat_writer import create_vmat_files
+        generate_textures(directory, size)
+        return lambda: create_vmat_files(directory, os.path.join(directory, 'vmat'), workers=workers)
+    if name == 'scale_images_in_directory':
+        from image_scaling import scale_images_in_directory
+        generate_textures(directory, size)
+        return lambda: scale_images_in_directory(directory, max_size_output=(1024, 1024), workers=workers)
+    if name == 'find_texture_sets':
+        from pbr_texture_creator import TextureSetFinder
+        generate_texture_sets(directory, size)
+        return lambda: TextureSetFinder(directory, os.path.join(directory, 'out'), workers=workers).find_texture_sets()
+    if name == 'create_subdirectories_with_files':
+        from fbx_splitter import create_subdirectories_with_files
+        fbx_directory = generate_fbx_files(directory, size)
+        return lambda: create_subdirectories_with_files(fbx_directory, max(size // 10, 1), workers=workers)
+    if name == 'traverse_and_generate_models':
+        from model_writer import traverse_and_generate_models
+        fbx_directory = generate_fbx_files(directory, size, files_per_folder=max(size // 10, 1))
+        return lambda: traverse_and_generate_models(fbx_directory, workers=workers)
+    raise ValueError(f"Unknown benchmark {name}, expected one of {BENCHMARKS}.")
+
+
+def get_tree_rss_kb(pid):
+    """
+    Get the total resident memory of a process and all its descendants, e.g. the workers of a process pool.
+
+    :param pid: The process id.
+    :return: The total RSS in KB, or None where /proc is not available.
+    """
+    children = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat', 'rb') as stat_file:
+                        stat = stat_file.read()
+                except OSError:
+                    continue  # The process exited in the meantime
+                parent = int(stat[stat.rindex(b')') + 2:].split()[1])
+                children.setdefault(parent, []).append(int(entry))
+    except OSError:
+        return None
+
+    page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, ()))
+        try:
+            with open(f'/proc/{current}/statm', 'rb') as statm_file:
+                total += int(statm_file.read().split()[1]) * page_kb
+        except OSError:
+            continue
+    return total
+
+
+class TreeRssSampler(threading.Thread):
+    """Samples the total RSS of this process and its descendants and keeps the peak."""
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_kb = get_tree_rss_kb(os.getpid())
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while self.peak_kb is not None and not self._stop_event.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, get_tree_rss_kb(os.getpid()) or 0)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak_kb
+
+
+def _run_in_child(name, size, workers, queue):
+    directory = tempfile.mkdtemp(prefix='bench_')
+    try:
+        run = _prepare(name, directory, size, workers)
+        sampler = TreeRssSampler()
+        sampler.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+        peak_total_rss_kb = sampler.stop()
+        # The largest single process, since the kernel keeps the peak of each child rather than of their sum
+        peak_process_rss_kb = None
+        if resource:
+            peak_process_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            if sys.platform == 'darwin':
+                peak_process_rss_kb //= 1024  # Reported in bytes on macOS
+        queue.put((seconds, (peak_process_rss_kb, peak_total_rss_kb), None))
+    except Exception as e:
+        queue.put((None, (None, None), f"{type(e).__name__}: {e}"))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_benchmark(name, size, workers=1):
+    """
+    Run one benchmark on a freshly generated corpus in a separate process, so that the peak RSS is its own.
+
+    Two peaks are recorded: peak_process_rss_kb is the largest peak of any single process of the run, and
+    peak_total_rss_kb the largest total of the run's process and its workers, sampled every 50 ms on systems with
+    /proc and None elsewhere. Pages shared between processes count once per process in the total.
+
+    :param name: The name of the benchmarked function.
+    :param size: The number of files in the corpus.
+    :param workers: The number of workers passed to the benchmarked function.
+    :return: A dict with the wall time, files per second and peak RSS.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(name, size, workers, queue))
+    process.start()
+    seconds, (peak_process_rss_kb, peak_total_rss_kb), error = queue.get()
+    process.join()
+    if error:
+        raise RuntimeError(f"Benchmark {name} with {size} files failed: {error}")
+    return {'benchmark': name, 'files': size, 'workers': workers, 'seconds': round(seconds, 4),
+            'files_per_second': round(size / seconds, 1) if seconds else None,
+            'peak_process_rss_kb': peak_process_rss_kb, 'peak_total_rss_kb': peak_total_rss_kb}
+
+
+def compare(results, baseline):
+    """Print the change of every result against the matching result of a baseline."""
+    baseline_results = {(result['benchmark'], result['files'], result.get('workers', 1)): result
+                        for result in baseline['results']}
+    for result in results:
+        previous = baseline_results.get((result['benchmark'], result['files'], result.get('workers', 1)))
+        if previous:
+            change = (result['seconds'] / previous['seconds'] - 1) * 100 if previous['seconds'] else 0.0
+            print(f"{result['benchmark']:<34} {result['files']:>7} files: {previous['seconds']:.3f}s -> "
+                  f"{result['seconds']:.3f}s ({change:+.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the conversion scripts on synthetic corpora.")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="The functions to benchmark.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES),
+                        help="The corpus sizes in files.")
+    parser.add_argument("--workers", type=int, default=1, help="The number of workers of each benchmarked function.")
+    parser.add_argument("--output", default="benchmark_baseline.json", help="Where to write the results.")
+    parser.add_argument("--compare", help="A previous results file to compare against.")
+    args = parser.parse_args()
+
+    results = []
+    for benchmark in args.benchmarks:
+        for corpus_size in args.sizes:
+            result = run_benchmark(benchmark, corpus_size, args.workers)
+            print(f"{benchmark:<34} {corpus_size:>7} files: {result['seconds']:.3f}s, "
+                  f"{result['files_per_second']} files/s, peak RSS {result['peak_total_rss_kb']} KB in total, "
+                  f"{result['peak_process_rss_kb']} KB in the largest process")
+            results.append(result)
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(), 'results': results},
+                  output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            compare(results, json.load(baseline_file))
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import threading
+
+# One manifest per stage and directory, so that stages running at the same time never write the same file
+MANIFEST_NAME = '.build_cache.{}.json'
+
+
+def get_file_state(file_path):
+    """
+    Get the size, modification time and content hash of a file.
+
+    :param file_path: The path to the file.
+    :return: A dict with the size, mtime_ns and sha256 of the file.
+    """
+    stat = os.stat(file_path)
+    with open(file_path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256').hexdigest()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+
+
+class BuildCache:
+    """
+    A persistent JSON manifest recording the inputs, parameters and outputs of each processed item, so that items
+    whose inputs and parameters did not change since the last run can be skipped.
+
+    Entries are grouped by step name and keyed by an item key, usually the source path. An input counts as
+    unchanged if its size and modification time match, or if only the modification time differs but the content
+    hash still matches.
+    """
+
+    def __init__(self, manifest_path, force=False):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        if not force and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as manifest_file:
+                    self.entries = json.load(manifest_file)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"Ignoring unreadable build cache {manifest_path}: {e}")
+
+    @classmethod
+    def for_directory(cls, directory, stage, force=False):
+        """
+        Open the build cache a stage keeps in a directory.
+
+        :param directory: The directory to keep the manifest in.
+        :param stage: The name of the stage, e.g. 'vmat', which names the manifest.
+        :param force: Whether to ignore the recorded entries.
+        """
+        return cls(os.path.join(directory, MANIFEST_NAME.format(stage)), force)
+
+    def get(self, step, key):
+        return self.entries.get(step, {}).get(key)
+
+    def is_fresh(self, step, key, inputs, params=None, outputs=()):
+        """
+        Check whether an item can be skipped.
+
+        :param step: The name of the processing step.
+        :param key: The key of the item within the step.
+        :param inputs: The paths of all files the item is built from.
+        :param params: The parameters the item is built with, which must be JSON serializable.
+        :param outputs: The paths of all files the item produces, which must still exist.
+        :return: True if the inputs and parameters match the recorded ones and all outputs exist.
+        """
+        entry = self.get(step, key)
+        if entry is None or entry['params'] != _normalize(params) or sorted(entry['inputs']) != sorted(inputs):
+            return False
+        if not all(os.path.exists(output) for output in outputs):
+            return False
+
+        for input_path, recorded in entry['inputs'].items():
+            try:
+                stat = os.stat(input_path)
+            except OSError:
+                return False
+            if stat.st_size != recorded['size']:
+                return False
+            if stat.st_mtime_ns != recorded['mtime_ns'] and get_file_state(input_path)['sha256'] != recorded['sha256']:
+                return False
+        return True
+
+    def record(self, step, key, inputs, params=None, **extra):
+        """
+        Record the current state of the inputs of an item after it has been processed.
+
+        :param step: The name of the processing step.
+        :param key: The key of the item within the step.
+        :param inputs: The paths of all files the item is built from.
+        :param params: The parameters the item was built with.
+        :param extra: Additional JSON serializable values to store with the entry.
+        """
+        self.entries.setdefault(step, {})[key] = {
+            'inputs': {input_path: get_file_state(input_path) for input_path in inputs},
+            'params': _normalize(params),
+            **extra
+        }
+
+    def forget(self, step, key):
+        """Forget the entry of an item, e.g. after its outputs were removed."""
+        self.entries.get(step, {}).pop(key, None)
+
+    def invalidate(self, step=None):
+        """
+        Forget all recorded entries, or only those of one step.
+
+        :param step: The name of the step to forget, or None to forget everything.
+        """
+        if step is None:
+            self.entries = {}
+        else:
+            self.entries.pop(step, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        temp_path = f"{self.manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(self.entries, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+
+def _normalize(params):
+    # Round-trip through JSON so tuples and lists compare equal to what was loaded from the manifest
+    return json.loads(json.dumps(params, sort_keys=True))
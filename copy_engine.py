@@ -0,0 +1,127 @@
+import errno
+import os
+import shutil
+import threading
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where reflinks are not attempted
+    fcntl = None
+
+# ioctl request number of FICLONE on Linux, which makes the destination share the blocks of the source
+FICLONE = 0x40049409
+
+LINK_MODES = ('copy', 'reflink', 'hardlink')
+
+# Errors of FICLONE meaning the filesystem cannot clone between the two devices at all
+REFLINK_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL)
+
+
+class CopyEngine:
+    """
+    Copies files while avoiding byte copies where possible.
+
+    A destination whose size and modification time already match its source is left alone, and each
+    destination is only handled once per engine. Depending on the link mode the destination is created as a
+    reflink (a copy-on-write clone, safe to modify afterwards) or a hardlink (shares the file with the source),
+    falling back to a regular copy where the filesystem does not support it. Once a reflink between two devices
+    failed as unsupported, files between them are copied right away.
+    """
+
+    def __init__(self, link_mode='reflink'):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {link_mode}, expected one of {LINK_MODES}.")
+        self.link_mode = link_mode
+        self.counts = {'copied': 0, 'reflinked': 0, 'hardlinked': 0, 'up to date': 0, 'duplicate': 0}
+        self.bytes_copied = 0
+        self.bytes_avoided = 0
+        self._done = set()
+        self._no_reflink = set()  # (source device, destination device) pairs that cannot reflink
+        self._lock = threading.Lock()
+
+    def copy(self, file_path, destination_path):
+        """
+        Copy a file, or link it or skip it if that gives the same result.
+
+        :param file_path: The path to the source file.
+        :param destination_path: The path the file is copied to.
+        :return: How the file was handled, one of the keys of counts.
+        """
+        with self._lock:
+            duplicate = destination_path in self._done
+            self._done.add(destination_path)
+
+        source_stat = os.stat(file_path)
+        if duplicate:
+            result = 'duplicate'
+        elif _is_up_to_date(source_stat, destination_path):
+            result = 'up to date'
+        elif self.link_mode == 'hardlink' and _hardlink(file_path, destination_path):
+            result = 'hardlinked'
+        elif self.link_mode == 'reflink' and self._reflink(file_path, destination_path, source_stat):
+            result = 'reflinked'
+        else:
+            shutil.copy2(file_path, destination_path)
+            result = 'copied'
+
+        with self._lock:
+            self.counts[result] += 1
+            if result == 'copied':
+                self.bytes_copied += source_stat.st_size
+            else:
+                self.bytes_avoided += source_stat.st_size
+        metrics.count('copy' if result == 'copied' else result, size=source_stat.st_size)
+        return result
+
+    def _reflink(self, file_path, destination_path, source_stat):
+        devices = (source_stat.st_dev, os.stat(os.path.dirname(destination_path) or os.curdir).st_dev)
+        if devices in self._no_reflink:
+            return False
+        try:
+            _reflink(file_path, destination_path)
+        except OSError as e:
+            if e.errno in REFLINK_UNSUPPORTED_ERRORS:
+                with self._lock:
+                    self._no_reflink.add(devices)
+            return False
+        return True
+
+    def summary(self):
+        counts = ', '.join(f"{count} {result}" for result, count in self.counts.items() if count)
+        return f"Files: {counts or 'none'}. Copied {self.bytes_copied} bytes, avoided copying {self.bytes_avoided} bytes."
+
+
+def _is_up_to_date(source_stat, destination_path):
+    try:
+        destination_stat = os.stat(destination_path)
+    except OSError:
+        return False
+    return (destination_stat.st_size == source_stat.st_size
+            and destination_stat.st_mtime_ns == source_stat.st_mtime_ns)
+
+
+def _hardlink(file_path, destination_path):
+    temp_path = destination_path + '.link'
+    try:
+        os.link(file_path, temp_path)
+    except OSError:
+        return False
+    os.replace(temp_path, destination_path)
+    return True
+
+
+def _reflink(file_path, destination_path):
+    # Raises OSError if the file cannot be cloned
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    temp_path = destination_path + '.reflink'
+    try:
+        with open(file_path, 'rb') as source, open(temp_path, 'wb') as destination:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    shutil.copystat(file_path, temp_path)
+    os.replace(temp_path, destination_path)
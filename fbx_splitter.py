@@ -1,26 +1,213 @@
 import os
-import shutil
+import re
+import json
+import heapq
+import mmap
+import math
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
 
+BALANCE_MODES = (None, 'size', 'triangles')
+JOURNAL_NAME = '.fbx_split_journal.json'
 
-def create_subdirectories_with_files(directory: str, num_files: int):
 
+@metrics.timed('split')
+def create_subdirectories_with_files(directory: str, num_files: int, balance: str = None,
+                                     group_by_name: bool = False, dry_run: bool = False, workers: int = 1):
+    """
+    Move the .fbx files of a directory into numbered subdirectories of at most num_files files each.
+
+    By default the files are split by count in directory order. With balance set to 'size' or 'triangles' the same
+    number of subdirectories is used, but the files are distributed so that every subdirectory gets roughly the same
+    total file size or estimated triangle count. The heaviest files are placed first, each into the lightest
+    subdirectory. With group_by_name the files instead stay in name order and are cut into contiguous runs of
+    roughly equal weight, which keeps files with neighbouring names, e.g. neighbouring chunks, together.
+
+    The complete move plan is written to a journal in the directory before any file is moved, and the journal is
+    removed once all moves are done. If a split was interrupted, calling this again resumes the moves from the
+    journal instead of planning a new split. A directory without .fbx files of its own but with numbered
+    subdirectories counts as already split and is left as it is, so the split can be part of a pipeline that is run
+    again. The moves are renames within the directory, run in parallel batches.
+
+    :param directory: The directory containing the .fbx files.
+    :param num_files: The maximum number of files per subdirectory.
+    :param balance: None, 'size' or 'triangles'.
+    :param group_by_name: Whether to keep files in name order when balancing.
+    :param dry_run: Whether to only print the move plan without touching any files.
+    :param workers: The number of threads used to move the files.
+    """
     if not os.path.isdir(directory):
         raise ValueError(f"The directory {directory} does not exist.")
+    if balance not in BALANCE_MODES:
+        raise ValueError(f"Unknown balance mode {balance}, expected one of {BALANCE_MODES}.")
+
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    if os.path.exists(journal_path):
+        with open(journal_path, 'r') as journal_file:
+            moves = [tuple(move) for move in json.load(journal_file)['moves']]
+        print(f"Resuming the interrupted split of {directory} from {journal_path}")
+    elif is_split(directory):
+        print(f"{directory} is already split, nothing to move")
+        return []
+    else:
+        moves = plan_moves(directory, num_files, balance, group_by_name)
+
+    if dry_run:
+        for fbx_file, subdir in moves:
+            print(f"Would move {fbx_file} to {subdir}")
+        return moves
+
+    _write_journal(journal_path, moves)
+    execute_moves(directory, moves, workers)
+    os.remove(journal_path)
+    return moves
+
 
+def is_split(directory: str) -> bool:
+    """
+    Check whether a directory was already split, i.e. has numbered subdirectories and no .fbx files of its own.
+    """
+    entries = os.listdir(directory)
+    return (not any(f.endswith('.fbx') for f in entries) and
+            any(f.isdigit() and os.path.isdir(os.path.join(directory, f)) for f in entries))
+
+
+def plan_moves(directory: str, num_files: int, balance: str = None, group_by_name: bool = False) -> list:
+    """
+    Plan how the .fbx files of a directory are split into subdirectories, without moving anything.
+
+    :return: A list of (file name, subdirectory name) tuples.
+    """
     fbx_files = [f for f in os.listdir(directory) if f.endswith('.fbx')]
 
     if len(fbx_files) < num_files:
         raise ValueError(
             f"There are not enough .fbx files in the directory to distribute {num_files} files per subdirectory.")
 
-    subdir_index = 1
-    for i in range(0, len(fbx_files), num_files):
-        subdir_name = os.path.join(directory, str(subdir_index))
-        os.makedirs(subdir_name, exist_ok=True)
+    if balance is None:
+        buckets = [fbx_files[i:i + num_files] for i in range(0, len(fbx_files), num_files)]
+    else:
+        if balance == 'size':
+            weights = {f: os.path.getsize(os.path.join(directory, f)) for f in fbx_files}
+        else:
+            weights = {f: estimate_triangle_count(os.path.join(directory, f)) for f in fbx_files}
+
+        bucket_count = math.ceil(len(fbx_files) / num_files)
+        if group_by_name:
+            buckets = _partition_contiguous(sorted(fbx_files), weights, bucket_count, num_files)
+        else:
+            buckets = _partition_longest_first(fbx_files, weights, bucket_count, num_files)
+
+        for subdir_index, bucket in enumerate(buckets, start=1):
+            print(f"Subdirectory {subdir_index}: {len(bucket)} files, weight {sum(weights[f] for f in bucket)}")
+
+    return [(fbx_file, str(subdir_index))
+            for subdir_index, bucket in enumerate(buckets, start=1)
+            for fbx_file in bucket]
+
+
+def execute_moves(directory: str, moves: list, workers: int = 1, batch_size: int = 256):
+    """
+    Execute a move plan with renames. Moves whose file is already in its subdirectory are skipped, so a partially
+    executed plan can simply be executed again.
+
+    :param directory: The directory containing the .fbx files.
+    :param moves: A list of (file name, subdirectory name) tuples.
+    :param workers: The number of threads used to move the files.
+    :param batch_size: The number of moves per batch handed to a thread.
+    """
+    for subdir in sorted({subdir for _, subdir in moves}):
+        os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+
+    batches = [moves[i:i + batch_size] for i in range(0, len(moves), batch_size)]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(_execute_batch, directory, batch) for batch in batches]:
+                future.result()
+    else:
+        for batch in batches:
+            _execute_batch(directory, batch)
+
+
+def _execute_batch(directory, batch):
+    for fbx_file, subdir in batch:
+        src = os.path.join(directory, fbx_file)
+        dst = os.path.join(directory, subdir, fbx_file)
+        if os.path.exists(src):
+            start = time.perf_counter()
+            os.replace(src, dst)
+            metrics.file_done('split', dst, time.perf_counter() - start)
+            metrics.count('move')
+        elif not os.path.exists(dst):
+            raise FileNotFoundError(f"{fbx_file} is neither in {directory} nor in its subdirectory {subdir}.")
+
+
+def _write_journal(journal_path, moves):
+    temp_path = journal_path + '.tmp'
+    with open(temp_path, 'w') as journal_file:
+        json.dump({'moves': moves}, journal_file)
+        metrics.count('write', size=journal_file.tell())
+    os.replace(temp_path, journal_path)
+
+
+def estimate_triangle_count(file_path: str) -> int:
+    """
+    Estimate the triangle count of an .fbx file from the lengths of its PolygonVertexIndex arrays, without parsing
+    the rest of the file. Falls back to the file size if no such array is found.
+
+    :param file_path: The path to the .fbx file.
+    :return: The estimated number of triangles.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            indices = 0
+            position = data.find(b'PolygonVertexIndex')
+            while position != -1:
+                end = position + len(b'PolygonVertexIndex')
+                if data[end:end + 1] == b'i' and end + 5 <= len(data):
+                    # Binary FBX: the name is followed by an int32 array property and its element count
+                    indices += struct.unpack('<I', data[end + 1:end + 5])[0]
+                else:
+                    # ASCII FBX: PolygonVertexIndex: *<count> {
+                    match = re.match(rb':\s*\*(\d+)', data[end:end + 32])
+                    if match:
+                        indices += int(match.group(1))
+                position = data.find(b'PolygonVertexIndex', end)
+            if indices == 0:
+                return len(data)
+            return indices // 3
+
+
+def _partition_longest_first(files, weights, bucket_count, max_per_bucket):
+    # Longest processing time first: place the heaviest remaining file into the lightest bucket with room left
+    buckets = [[] for _ in range(bucket_count)]
+    heap = [(0, index) for index in range(bucket_count)]
+    for f in sorted(files, key=lambda name: (-weights[name], name)):
+        weight, index = heapq.heappop(heap)
+        buckets[index].append(f)
+        if len(buckets[index]) < max_per_bucket:
+            heapq.heappush(heap, (weight + weights[f], index))
+    return buckets
 
-        for fbx_file in fbx_files[i:i + num_files]:
-            src = os.path.join(directory, fbx_file)
-            dst = os.path.join(subdir_name, fbx_file)
-            shutil.move(src, dst)
 
-        subdir_index += 1
+def _partition_contiguous(files, weights, bucket_count, max_per_bucket):
+    # Cut the ordered files into runs, starting a new run once the current one reaches its share of the total weight,
+    # but never so early that the remaining runs could not hold the remaining files
+    total = sum(weights[f] for f in files)
+    buckets = [[]]
+    accumulated = 0
+    for index, f in enumerate(files):
+        remaining_buckets = bucket_count - len(buckets)
+        current = buckets[-1]
+        if current and remaining_buckets and (
+                len(current) >= max_per_bucket or
+                (accumulated >= total * len(buckets) / bucket_count and
+                 len(files) - index <= remaining_buckets * max_per_bucket)):
+            buckets.append([])
+        buckets[-1].append(f)
+        accumulated += weights[f]
+    return buckets
@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+from metrics import metrics
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+
+def get_image_bytes(img):
+    """
+    Get the memory Pillow uses for the pixels of an image. Single band 8-bit images take one byte per pixel, 16-bit
+    ones two and everything else, including RGB, four.
+    """
+    if img.mode in ('1', 'L', 'P'):
+        return img.width * img.height
+    if img.mode.startswith('I;16'):
+        return img.width * img.height * 2
+    return img.width * img.height * 4
+
+
+class ImageCache:
+    """
+    Keeps decoded images in memory up to a budget of bytes, so that a file read by several stages of a run is only
+    decoded once. Entries are keyed by path and checked against the size and modification time of the file, so a
+    file changed on disk is decoded again. When the budget is exceeded, the least recently used images are evicted.
+
+    Files written with png_encoding.save_png are stored with the pixels that were written, so a later stage reading
+    them, e.g. vmat after an in-place scale, does not decode them at all.
+
+    The cached images are shared and must not be modified. Pillow operations such as convert, resize and split return
+    new images, but e.g. putalpha and paste work in place, so convert or copy the image first.
+
+    Every process has its own cache. Process pools turn it off in their workers with disable_in_worker, since a
+    worker reads each file once and never reads back what it writes.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._images = OrderedDict()  # Path to (size, mtime_ns, image, bytes), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, budget):
+        """
+        Set the memory budget, evicting images if it shrinks.
+
+        :param budget: The maximum number of bytes of decoded pixels to keep, or 0 to disable the cache.
+        """
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.bytes = 0
+
+    def load(self, path):
+        """
+        Get the decoded image of a file, from the cache if the file did not change since it was cached.
+
+        :param path: The path to the image file.
+        :return: The decoded image, which must not be modified.
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._images.get(path)
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                self._images.move_to_end(path)
+                self.hits += 1
+                metrics.count('image cache hit')
+                return entry[2]
+            self.misses += 1
+        metrics.count('image cache miss')
+
+        with Image.open(path) as img:
+            img.load()
+        self._put(path, stat, img)
+        return img
+
+    def store(self, path, img):
+        """
+        Cache the pixels just written to a file, so that reading the file does not decode it again. The image must
+        not be modified afterwards. Palette images are not stored, since the decoded file keeps its transparency in
+        other metadata than a palette image built in memory.
+
+        :param path: The path to the file written.
+        :param img: The image decoding the file gives, in pixels and mode.
+        """
+        self._put(path, os.stat(path), img if img.mode != 'P' else None)
+
+    def _put(self, path, stat, img):
+        size = get_image_bytes(img) if img is not None else 0
+        with self._lock:
+            old_entry = self._images.pop(path, None)
+            if old_entry:
+                self.bytes -= old_entry[3]
+            if img is None or size > self.budget:
+                return
+            self._images[path] = (stat.st_size, stat.st_mtime_ns, img, size)
+            self.bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.budget and self._images:
+            _, (_, _, _, size) = self._images.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            metrics.count('image cache eviction')
+
+    def stats(self):
+        """
+        :return: A dict with the hits, misses, evictions, the number of cached images and their bytes.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'images': len(self._images), 'bytes': self.bytes}
+
+
+# The decoded images of this process, shared by all stages
+image_cache = ImageCache()
+
+
+def disable_in_worker():
+    """
+    Process pool initializer turning the image cache of a worker process off, so that it holds no memory. Worker
+    processes start with the default budget, not the one configured in the calling process.
+    """
+    image_cache.configure(0)
@@ -1,54 +1,264 @@
 import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import glob
+from build_cache import BuildCache
+from image_cache import disable_in_worker, image_cache
+from metrics import metrics, timed_call
+from png_encoding import get_png_options, get_integer_factor, get_preset_params, save_png, to_palette
 
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def get_scaled_size(width, height, scale_factor, max_size_output=None):
+    new_size = (width * scale_factor, height * scale_factor)
+    if max_size_output:
+        aspect_ratio = width / height
+        if new_size[0] > max_size_output[0] or new_size[1] > max_size_output[1]:
+            if aspect_ratio > 1:
+                new_size = (max_size_output[0], int(max_size_output[0] / aspect_ratio))
+            else:
+                new_size = (int(max_size_output[1] * aspect_ratio), max_size_output[1])
+    return new_size
+
+
+def scale_image(input_filepath, scale_factor=8, max_size=(32, 32), min_size=(0, 0), max_size_output=None,
+                output_filepath=None, png_preset='default'):
+    """
+    Scale a single image without printing, so it can run in a worker process.
+
+    When the image is scaled by the same integer factor in both directions, which is the case unless
+    max_size_output limits the size, the pixels are replicated in the mode of the image, so palette images stay
+    palette images. A preset converting to a palette does so before scaling then, on the few source pixels.
+
+    :param output_filepath: Where to write the scaled image. The input file is overwritten if this is None.
+    :param png_preset: The name of a preset in png_encoding.PNG_PRESETS to save the scaled image with.
+    :return: A (status, message, new_size) tuple, where status is 'scaled', 'skipped' or 'failed' and new_size is
+             None unless the image was scaled.
+    """
+    status, message, new_sizes = scale_image_tiers(input_filepath, scale_factor, max_size, min_size,
+                                                   [(max_size_output, output_filepath)], png_preset)
+    return status, message, new_sizes[0] if new_sizes else None
+
+
+def scale_image_tiers(input_filepath, scale_factor, max_size, min_size, targets, png_preset='default'):
+    """
+    Scale a single image to several sizes from one decode, each from the original pixels. See scale_image.
+
+    :param targets: A list of (max_size_output, output_filepath) tuples, one per size to write.
+    :return: A (status, message, new_sizes) tuple, where new_sizes lists the size written for every target, or is
+             None unless the image was scaled.
+    """
+    filename = os.path.basename(input_filepath)
+    try:
+        # Files too large to scale are skipped from their header, without being decoded
+        width, height = read_png_size(input_filepath) or image_cache.load(input_filepath).size
+        if not (max_size[0] >= width >= min_size[0] and max_size[1] >= height >= min_size[1]):
+            return 'skipped', f"Skipped {filename} because its size is greater than {max_size}.", None
+
+        img = image_cache.load(input_filepath)
+        palette_img = None
+        new_sizes = []
+        for max_size_output, output_filepath in targets:
+            new_size = get_scaled_size(img.width, img.height, scale_factor, max_size_output)
+            if get_integer_factor(img.size, new_size):
+                if palette_img is None:
+                    palette_img = to_palette(img) if get_png_options(png_preset).get('palette') else img
+                scaled_img = palette_img.resize(new_size, Image.NEAREST)
+            else:
+                scaled_img = img.resize(new_size, Image.NEAREST)
+            if output_filepath is None:
+                output_filepath = input_filepath
+            else:
+                os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+            save_png(scaled_img, output_filepath, png_preset)
+            new_sizes.append(new_size)
+    except Exception as e:
+        return 'failed', f"Could not process {filename}: {e}", None
+
+    if len(targets) > 1:
+        return 'scaled', f"Scaled {filename} to {', '.join(map(str, new_sizes))} in {len(targets)} tiers.", new_sizes
+    if targets[0][1] is None:
+        return 'scaled', f"Scaled {filename} to {new_sizes[0]} and overwrote the original file.", new_sizes
+    return 'scaled', f"Scaled {filename} to {new_sizes[0]} and saved it to {targets[0][1]}.", new_sizes
+
+
+def get_tiers(tiers):
+    """
+    Normalize the tiers of a tiered scaling run.
+
+    :param tiers: A dict mapping tier names to (width, height) output size limits, or a list of square size limits,
+                  each named after its size.
+    :return: A dict mapping tier names to [width, height] lists.
+    """
+    if isinstance(tiers, dict):
+        return {str(name): list(size) for name, size in tiers.items()}
+    return {str(size): [size, size] for size in tiers}
+
+
+def read_png_size(input_filepath):
+    """
+    Read the size of a .png file from its IHDR chunk without decoding any pixel data.
+
+    :param input_filepath: The path to the .png file.
+    :return: A (width, height) tuple, or None if the file does not start with a valid PNG header.
+    """
+    with open(input_filepath, 'rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def get_pattern_root(input_pattern):
+    """
+    Get the longest leading directory of a glob pattern that does not contain any wildcards.
+
+    :param input_pattern: The glob pattern.
+    :return: The directory all matches of the pattern are below.
+    """
+    if not glob.has_magic(input_pattern):
+        return input_pattern
+    root = os.path.dirname(input_pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+
+def iter_png_files(input_directory, required_substring=None):
+    for root, _, files in os.walk(input_directory):
+        for filename in files:
+            if filename.lower().endswith('.png') and (required_substring is None or required_substring in filename):
+                yield os.path.join(root, filename)
+
+
+@metrics.timed('scale')
 def scale_images_in_directory(input_pattern, scale_factor=8, max_size=(32, 32), min_size=(0, 0),
-                              required_substring=None, max_size_output=None):
-    for input_directory in glob.glob(input_pattern):
-        for root, _, files in os.walk(input_directory):
-            for filename in files:
-                if filename.lower().endswith('.png') and (required_substring is None or required_substring in filename):
-                    input_filepath = os.path.join(root, filename)
-                    try:
-                        with Image.open(input_filepath) as img:
-                            if max_size[0] >= img.width >= min_size[0] and max_size[1] >= img.height >= min_size[1]:
-                                new_size = (img.width * scale_factor, img.height * scale_factor)
-                                if max_size_output:
-                                    aspect_ratio = img.width / img.height
-                                    if new_size[0] > max_size_output[0] or new_size[1] > max_size_output[1]:
-                                        if aspect_ratio > 1:
-                                            new_size = (max_size_output[0], int(max_size_output[0] / aspect_ratio))
-                                        else:
-                                            new_size = (int(max_size_output[1] * aspect_ratio), max_size_output[1])
-                                scaled_img = img.resize(new_size, Image.NEAREST)
-                                scaled_img.save(input_filepath)
-                                print(f"Scaled {filename} to {new_size} and overwrote the original file.")
-                            else:
-                                print(f"Skipped {filename} because its size is greater than {max_size}.")
-                    except Exception as e:
-                        print(f"Could not process {filename}: {e}")
-
-
-def scale_single_image(input_filepath, scale_factor=8, max_size=(32, 32), max_size_output=None):
+                              required_substring=None, max_size_output=None, workers=1, force=False,
+                              output_directory=None, png_preset='default', tiers=None):
+    """
+    Scale all matching .png files below the directories matched by input_pattern.
+
+    With more than one worker the file paths are streamed from the walk into a process pool. Only a few files per
+    worker are in flight at any time, so memory stays flat on huge trees, and results are reported in walk order.
+
+    By default the files are scaled in place. If an output directory is given, the inputs are never modified and the
+    scaled files are written to the same relative paths below the output directory, relative to the part of
+    input_pattern without wildcards.
+
+    The size of every file is first read from its PNG header, and files outside the size window are skipped
+    without being decoded or sent to a worker.
+
+    The files that were scaled or skipped are recorded with the given parameters and the applied size in a build
+    cache, kept in the output directory or else in each matched directory. Files that did not change since then are
+    not decoded again unless force is set.
+
+    The scaled files are saved with the given PNG preset, see png_encoding.PNG_PRESETS.
+
+    With tiers, every file is decoded once and scaled to each tier's output size limit, which replaces
+    max_size_output, always from the original pixels. Each tier is written to its own tree below the output
+    directory, e.g. tiers={'low': (512, 512), 'high': (2048, 2048)} writes to <output_directory>/low and
+    <output_directory>/high. A list of sizes such as [256, 512] names the tiers after the sizes.
+
+    :return: A dict mapping 'scaled', 'skipped', 'failed' and 'unchanged' to the lists of affected file paths, and
+             'bytes_saved' to the total size of the files skipped from their header alone.
+    """
+    preset_params = get_preset_params(png_preset)
+    if tiers is not None:
+        if not output_directory:
+            raise ValueError("Scaling to tiers requires an output directory.")
+        tiers = get_tiers(tiers)
+    summary = {'scaled': [], 'skipped': [], 'failed': [], 'unchanged': [], 'bytes_saved': 0}
+    params = {'scale_factor': scale_factor, 'max_size': max_size, 'min_size': min_size,
+              'max_size_output': max_size_output, 'output_directory': output_directory, **preset_params}
+    if tiers is not None:
+        params['tiers'] = tiers
+    pattern_root = get_pattern_root(input_pattern)
+    output_cache = BuildCache.for_directory(output_directory, 'scale', force) if output_directory else None
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=disable_in_worker) if workers > 1 else None
+    max_pending = workers * 4
+    pending = deque()
+    header_skipped = 0
+
+    def report(cache, input_filepath, timed_result):
+        seconds, (status, message, new_sizes) = timed_result
+        summary[status].append(input_filepath)
+        metrics.file_done('scale', input_filepath, seconds, status=status)
+        if status == 'failed':
+            print(message)
+            return
+        metrics.count('decode')
+        if status == 'scaled':
+            metrics.count('encode', len(new_sizes))
+        new_size = new_sizes if tiers is not None or new_sizes is None else new_sizes[0]
+        cache.record('scale', input_filepath, [input_filepath], params, new_size=new_size)
+        metrics.log(message)
+
+    try:
+        for input_directory in glob.glob(input_pattern):
+            cache = output_cache or BuildCache.for_directory(input_directory, 'scale', force)
+            try:
+                for input_filepath in iter_png_files(input_directory, required_substring):
+                    # Probing the header is about as cheap as the cache lookup, so these files are not recorded
+                    size = read_png_size(input_filepath)
+                    if size and not (max_size[0] >= size[0] >= min_size[0] and max_size[1] >= size[1] >= min_size[1]):
+                        summary['skipped'].append(input_filepath)
+                        header_skipped += 1
+                        summary['bytes_saved'] += os.path.getsize(input_filepath)
+                        metrics.count('header skip')
+                        metrics.log(f"Skipped {os.path.basename(input_filepath)} because its size is greater than "
+                                    f"{max_size}.")
+                        continue
+
+                    relative_path = os.path.relpath(input_filepath, pattern_root)
+                    if tiers is not None:
+                        targets = [(size, os.path.join(output_directory, name, relative_path))
+                                   for name, size in tiers.items()]
+                    elif output_directory:
+                        targets = [(max_size_output, os.path.join(output_directory, relative_path))]
+                    else:
+                        targets = [(max_size_output, None)]
+
+                    entry = cache.get('scale', input_filepath)
+                    outputs = [path for _, path in targets if path and entry and entry['new_size']]
+                    if cache.is_fresh('scale', input_filepath, [input_filepath], params, outputs):
+                        summary['unchanged'].append(input_filepath)
+                        metrics.count('unchanged')
+                        continue
+
+                    if executor is None:
+                        report(cache, input_filepath, timed_call(scale_image_tiers, input_filepath, scale_factor,
+                                                                 max_size, min_size, targets, png_preset))
+                        continue
+
+                    if len(pending) >= max_pending:
+                        done_filepath, future = pending.popleft()
+                        report(cache, done_filepath, future.result())
+                    pending.append((input_filepath, executor.submit(timed_call, scale_image_tiers, input_filepath,
+                                                                    scale_factor, max_size, min_size, targets,
+                                                                    png_preset)))
+                while pending:
+                    done_filepath, future = pending.popleft()
+                    report(cache, done_filepath, future.result())
+            finally:
+                cache.save()
+    finally:
+        if executor:
+            executor.shutdown()
+
+    print(f"Skipped decoding {header_skipped} files from their header, saving {summary['bytes_saved']} bytes "
+          f"of reads.")
+    return summary
+
+
+def scale_single_image(input_filepath, scale_factor=8, max_size=(32, 32), max_size_output=None,
+                       output_filepath=None, png_preset='default'):
     if input_filepath.lower().endswith('.png'):
-        try:
-            with Image.open(input_filepath) as img:
-                if img.width <= max_size[0] and img.height <= max_size[1]:
-                    new_size = (img.width * scale_factor, img.height * scale_factor)
-                    if max_size_output:
-                        aspect_ratio = img.width / img.height
-                        if new_size[0] > max_size_output[0] or new_size[1] > max_size_output[1]:
-                            if aspect_ratio > 1:
-                                new_size = (max_size_output[0], int(max_size_output[0] / aspect_ratio))
-                            else:
-                                new_size = (int(max_size_output[1] * aspect_ratio), max_size_output[1])
-                    scaled_img = img.resize(new_size, Image.NEAREST)
-                    scaled_img.save(input_filepath)
-                    print(f"Scaled {os.path.basename(input_filepath)} to {new_size} and overwrote the original file.")
-                else:
-                    print(f"Skipped {os.path.basename(input_filepath)} because its size is greater than {max_size}.")
-        except Exception as e:
-            print(f"Could not process {os.path.basename(input_filepath)}: {e}")
+        _, message, _ = scale_image(input_filepath, scale_factor, max_size, max_size_output=max_size_output,
+                                    output_filepath=output_filepath, png_preset=png_preset)
+        print(message)
     else:
         print(f"File {os.path.basename(input_filepath)} is not a .png file.")
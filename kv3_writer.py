@@ -0,0 +1,101 @@
+KV3_ENCODING_TEXT = ('text', 'e21c7f3c-8a33-41c5-9977-a76d3a32aa0d')
+KV3_FORMAT_MODELDOC = ('modeldoc36', '972dada4-b828-45a4-bb93-7795cf0585da')
+
+
+def quote(value):
+    """
+    Quote a string for a KeyValues file, escaping backslashes and double quotes.
+
+    :param value: The string to quote.
+    :return: The quoted string.
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def format_value(value):
+    """
+    Format a Python value as a KV3 value.
+
+    :param value: A string, bool, int, float or list of those.
+    :return: The KV3 text of the value.
+    """
+    if isinstance(value, str):
+        return quote(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return f"[ {', '.join(format_value(item) for item in value)} ]"
+    raise TypeError(f"Cannot write a value of type {type(value).__name__} to a KV3 file.")
+
+
+class KV3Writer:
+    """
+    Writes a KV3 text document straight to a file handle while it is being built, without keeping it in memory.
+
+    Objects and arrays are opened and closed explicitly. Inside an array, keys are omitted and the commas between
+    elements are written automatically.
+    """
+
+    def __init__(self, file, indent='    '):
+        self.file = file
+        self.indent = indent
+        self._containers = []  # Stack of [kind, element count] for the open objects and arrays
+        self._started = False
+
+    def write_header(self, encoding=KV3_ENCODING_TEXT, file_format=KV3_FORMAT_MODELDOC):
+        self.file.write(f"<!-- kv3 encoding:{encoding[0]}:version{{{encoding[1]}}} "
+                        f"format:{file_format[0]}:version{{{file_format[1]}}} -->")
+        self._started = True
+
+    def begin_object(self, key=None):
+        self._open(key, '{', 'object')
+
+    def end_object(self):
+        self._close('}')
+
+    def begin_array(self, key=None):
+        self._open(key, '[', 'array')
+
+    def end_array(self):
+        self._close(']')
+
+    def write_value(self, key, value):
+        self._element(f"{key} = {format_value(value)}")
+
+    def write_element(self, value):
+        self._element(format_value(value))
+
+    def finish(self):
+        if self._containers:
+            raise ValueError("Cannot finish a KV3 document with unclosed objects or arrays.")
+        self.file.write('\n')
+
+    def _in_array(self):
+        return bool(self._containers) and self._containers[-1][0] == 'array'
+
+    def _element(self, text):
+        if self._containers:
+            if self._containers[-1][1] and self._in_array():
+                self.file.write(',')
+            self._containers[-1][1] += 1
+        self._line(text)
+
+    def _open(self, key, bracket, kind):
+        if key is not None and not self._in_array():
+            self._element(f"{key} =")
+            self._line(bracket)
+        else:
+            self._element(bracket)
+        self._containers.append([kind, 0])
+
+    def _close(self, bracket):
+        self._containers.pop()
+        self._line(bracket)
+
+    def _line(self, text):
+        if self._started:
+            self.file.write('\n')
+        self._started = True
+        self.file.write(self.indent * len(self._containers) + text)
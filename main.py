@@ -1,44 +1,61 @@
-from image_scaling import scale_images_in_directory, scale_single_image
-from vmat_writer import create_vmat_files
-from fbx_splitter import create_subdirectories_with_files
-from model_writer import traverse_and_generate_models
-from pbr_texture_creator import TextureSetFinder
-from vmdl_remapper import VmdlProcessor
-
-# Example usage for scaling a single file
-# single_file_path = 'your_single_file_path'
-# scale_single_image(single_file_path, max_size=(10000, 10000), max_size_output=(2048, 2048))
-
-# Example usage for creating VMAT files
-# create_vmat_files(
-#    "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft",
-#    "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft")
-
-# Example usage for scaling images in a directory
-# Uncomment and replace 'your_project_directory' with the actual directory path
-# scale_images_in_directory(
-#    "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft\\models",
-#    required_substring=None, max_size_output=(1024, 1024), max_size=(1024, 1024), min_size=(1, 1))
-
-# Example usage for splitting FBX files into subdirectories
-# Uncomment and replace 'your_fbx_directory' with the actual directory path
-# create_subdirectories_with_files(
-# "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft\\models\\details\\fbx",
-# 2000)
-
-# Example usage for traversing directories and generating models
-# Uncomment and replace 'your_model_directory' with the actual directory path
-# traverse_and_generate_models(
-# "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft\\models\\details\\fbx")
-
-finder = TextureSetFinder('C:\\Users\\misch\\Downloads\\Vanilla-PBR-Deferred-Lighting-v2.2',
-                         'C:\\Users\\misch\\Downloads\\test')
-finder.find_texture_sets()
-
-# scale_images_in_directory(
-#    "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft\\materials\\pbr_minecraft",
-#    required_substring=None, max_size_output=(1024, 1024), max_size=(1024, 1024), min_size=(1, 1), scale_factor=64)
-
-#processor = VmdlProcessor("C:\\Users\\misch\\Downloads\\test1", "C:\\Users\\misch\\Downloads\\test1",
-#                          "D:\\SteamLibrary\\steamapps\\common\\Counter-Strike Global Offensive\\content\\csgo_addons\\de_anubis_minecraft")
-#processor.process_vmdl_files()
+import argparse
+from image_cache import DEFAULT_BUDGET, image_cache
+from metrics import metrics
+from pipeline import STAGES, load_config, run_pipeline
+
+# Runs the conversion stages configured in a JSON file, e.g.
+#
+# {
+#     "stages": {
+#         "scale": {"input_pattern": "D:\\...\\csgo_addons\\de_anubis_minecraft\\materials\\pbr_minecraft",
+#                   "max_size_output": [1024, 1024], "max_size": [1024, 1024], "min_size": [1, 1],
+#                   "scale_factor": 64},
+#         "vmat": {"source_directory": "D:\\...\\csgo_addons\\de_anubis_minecraft",
+#                  "target_directory": "D:\\...\\csgo_addons\\de_anubis_minecraft", "workers": 8},
+#         "pbr": {"input_dir": "C:\\Users\\...\\Vanilla-PBR-Deferred-Lighting-v2.2", "output_dir": "C:\\Users\\...\\test"},
+#         "split": {"directory": "D:\\...\\csgo_addons\\de_anubis_minecraft\\models\\details\\fbx", "num_files": 2000},
+#         "vmdl": {"directory": "D:\\...\\csgo_addons\\de_anubis_minecraft\\models\\details\\fbx"}
+#     }
+# }
+#
+# Each stage gets the keyword arguments of its function. vmat waits for scale and vmdl waits for split, everything
+# else runs at the same time. A stage can set "depends_on" to a list of stages to wait for instead.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the Minecraft to Source 2 conversion pipeline.")
+    parser.add_argument("config", help="The JSON file configuring the stages to run.")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES),
+                        help="Only run these of the configured stages.")
+    parser.add_argument("--force", action="store_true", help="Ignore the build caches and redo all work.")
+    parser.add_argument("--verbose", action="store_true", help="Print a message for every file.")
+    parser.add_argument("--events", help="A file to write the JSON lines event stream to.")
+    parser.add_argument("--profile", choices=list(STAGES), help="Profile this stage.")
+    parser.add_argument("--profile-mode", choices=['cprofile', 'tracemalloc'], default='cprofile',
+                        help="Profile the calls or the memory allocations of the stage.")
+    parser.add_argument("--image-cache-mb", type=int, default=DEFAULT_BUDGET // (1024 * 1024),
+                        help="The memory in MiB for decoded images shared between the stages, 0 to disable it.")
+    parser.add_argument("--watch", action="store_true",
+                        help="After the run, keep watching the sources of the vmat, pbr and vmdl stages and update "
+                             "the outputs of every changed file until interrupted.")
+    parser.add_argument("--poll", action="store_true", help="Watch by scanning the sources instead of using inotify.")
+    args = parser.parse_args()
+
+    metrics.configure(verbose=args.verbose, events_path=args.events)
+    image_cache.configure(args.image_cache_mb * 1024 * 1024)
+
+    stages = load_config(args.config)
+    if args.stages:
+        stages = {name: options for name, options in stages.items() if name in args.stages}
+        for options in stages.values():
+            if 'depends_on' in options:
+                options['depends_on'] = [name for name in options['depends_on'] if name in stages]
+
+    try:
+        results = run_pipeline(stages, force=args.force, profile_stage=args.profile, profile_mode=args.profile_mode)
+        if args.watch:
+            from watch import run_watch
+            run_watch(stages, polling=args.poll)
+    finally:
+        metrics.close()
+    if any(status != 'ok' for status, _ in results.values()):
+        raise SystemExit(1)
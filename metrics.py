@@ -0,0 +1,192 @@
+import io
+import json
+import functools
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+
+class Metrics:
+    """
+    Collects timings, counters and byte totals of the conversion stages.
+
+    Stages are timed with stage(), per-file work is recorded with file_done() and operations such as decodes,
+    encodes, copies and writes with count(). Everything is kept in memory and reported by summary(). If an event
+    file is configured, every stage and file is also written to it as one JSON object per line.
+
+    Per-file messages go through log(), which only prints them in verbose mode, since printing every file is a
+    noticeable part of the runtime on large trees.
+
+    Only the process the metrics are recorded in is covered, so work done in worker processes is recorded by the
+    calling process when the results come back, see timed_call().
+    """
+
+    def __init__(self):
+        self.verbose = False
+        self._events = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stage_times = {}  # Stage name to total seconds
+        self.file_times = {}  # Stage name to [file count, total seconds, slowest seconds]
+        self.counters = {}  # Operation name to count
+        self.byte_totals = {}  # Operation name to bytes
+
+    def configure(self, verbose=None, events_path=None):
+        """
+        Configure the output of the metrics.
+
+        :param verbose: Whether to print the per-file messages, or None to leave it unchanged.
+        :param events_path: A path to write the JSON lines event stream to, or None to not write one.
+        """
+        if verbose is not None:
+            self.verbose = verbose
+        self.close()
+        if events_path:
+            self._events = open(events_path, 'a')
+
+    def close(self):
+        with self._lock:
+            if self._events:
+                self._events.close()
+                self._events = None
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def event(self, kind, **fields):
+        if self._events:
+            line = json.dumps({'time': time.time(), 'event': kind, **fields})
+            with self._lock:
+                if self._events:
+                    self._events.write(line + '\n')
+
+    def count(self, operation, amount=1, size=0):
+        """
+        Count an operation, e.g. 'decode', 'encode', 'copy' or 'write'.
+
+        :param operation: The name of the operation.
+        :param amount: How often it was done.
+        :param size: The number of bytes it handled.
+        """
+        with self._lock:
+            self.counters[operation] = self.counters.get(operation, 0) + amount
+            if size:
+                self.byte_totals[operation] = self.byte_totals.get(operation, 0) + size
+
+    def file_done(self, stage, path, seconds=None, **fields):
+        """
+        Record that a stage finished a file.
+
+        :param stage: The name of the stage.
+        :param path: The path of the file.
+        :param seconds: The time spent on the file, if it was measured.
+        :param fields: Additional JSON serializable values for the event stream, e.g. the result.
+        """
+        with self._lock:
+            file_time = self.file_times.setdefault(stage, [0, 0.0, 0.0])
+            file_time[0] += 1
+            if seconds is not None:
+                file_time[1] += seconds
+                file_time[2] = max(file_time[2], seconds)
+        self.event('file', stage=stage, path=path, seconds=seconds, **fields)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage. Nested and repeated timings of the same stage add up."""
+        self.event('stage_start', stage=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.stage_times[name] = self.stage_times.get(name, 0.0) + seconds
+            self.event('stage_end', stage=name, seconds=seconds)
+
+    def timed(self, name):
+        """Decorate a function so that every call is timed as the given stage."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        lines = ["Run summary:"]
+        for name, seconds in self.stage_times.items():
+            lines.append(f"  stage {name:<10} {seconds:.2f}s")
+        for name, (files, seconds, slowest) in self.file_times.items():
+            average = seconds / files * 1000 if files else 0.0
+            lines.append(f"  files {name:<10} {files} files, {average:.2f}ms average, {slowest * 1000:.2f}ms slowest")
+        for operation, amount in sorted(self.counters.items()):
+            size = self.byte_totals.get(operation)
+            lines.append(f"  {operation:<16} {amount}" + (f" ({size} bytes)" if size else ""))
+        return '\n'.join(lines)
+
+
+# The metrics of this process, shared by all stages
+metrics = Metrics()
+
+
+def timed_call(function, *args):
+    """
+    Call a function and measure how long it took, so that worker processes can report their time per file.
+
+    :return: A (seconds, result) tuple.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+@contextlib.contextmanager
+def profile(name, mode='cprofile', output_path=None, limit=25):
+    """
+    Profile the code run inside the context and print the results when it exits.
+
+    With mode 'cprofile' the calls of the current thread are profiled, with mode 'tracemalloc' the memory
+    allocations of the whole process are traced and the largest allocation sites and the peak are printed. Worker
+    processes are not covered.
+
+    :param name: The name of the profiled stage, used in the report.
+    :param mode: 'cprofile' or 'tracemalloc'.
+    :param output_path: An optional path to dump the raw cProfile statistics to, for use with pstats or snakeviz.
+    :param limit: The number of entries to print.
+    """
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output_path:
+                profiler.dump_stats(output_path)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(limit)
+            print(f"Profile of stage {name}:\n{report.getvalue()}")
+    elif mode == 'tracemalloc':
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not already_tracing:
+                tracemalloc.stop()
+            print(f"Memory of stage {name}: {current} bytes still allocated, peak {peak} bytes. Largest sites:")
+            for statistic in snapshot.statistics('lineno')[:limit]:
+                print(f"  {statistic}")
+    else:
+        raise ValueError(f"Unknown profile mode {mode}, expected 'cprofile' or 'tracemalloc'.")
@@ -1,79 +1,216 @@
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from build_cache import BuildCache
+from kv3_writer import KV3Writer
+from metrics import metrics, timed_call
 
 
-def traverse_and_generate_models(directory: str):
-    for root, dirs, files in os.walk(directory):
-        for subdir in dirs:
-            subdir_path = os.path.join(root, subdir)
-            parent_dir = os.path.dirname(subdir_path)
+@metrics.timed('vmdl')
+def traverse_and_generate_models(directory: str, addon_directory: str = None, workers: int = 1, force: bool = False):
+    """
+    Generate a detail_model_<name>.vmdl file next to every subdirectory of the given directory, referencing all
+    .fbx files below that subdirectory.
+
+    The tree is scanned only once. The .fbx paths in the models are relative to the addon directory, which is
+    found from the csgo_addons folder in the path unless it is given.
+
+    The sorted .fbx files and their modification times are recorded per model in a build cache in the directory.
+    Models whose manifest did not change are skipped, and the others are only written if their content changed, so
+    unchanged .vmdl files keep their modification time and are not recompiled.
+
+    :param directory: The directory containing the subdirectories with .fbx files.
+    :param addon_directory: The root directory of the addon, e.g. content/csgo_addons/<addon>.
+    :param workers: The number of threads used to write the .vmdl files.
+    :param force: Whether to ignore the build cache and check every model again.
+    """
+    cache = BuildCache.for_directory(directory, 'vmdl', force)
+    subtrees = {}
+    _collect_fbx_files(directory, subtrees)
+
+    models = []
+    for subdir_path, fbx_files in subtrees.items():
+        if subdir_path == directory:
+            continue
+        if not fbx_files:
+            raise ValueError(f"No .fbx files found in the directory {subdir_path}.")
+        parent_dir, subdir = os.path.split(subdir_path)
+        output_file = os.path.join(parent_dir, f"detail_model_{subdir}.vmdl")
+        manifest = [[get_addon_relative_path(path, addon_directory), mtime_ns] for path, mtime_ns in fbx_files]
+        if cache.is_fresh('vmdl', output_file, [], manifest, outputs=[output_file]):
+            metrics.count('unchanged')
+            continue
+        models.append((output_file, manifest))
+
+    output_files = [model[0] for model in models]
+    manifests = [model[1] for model in models]
+    if workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        results = executor.map(timed_call, repeat(_write_model), output_files, manifests)
+    else:
+        executor = None
+        results = map(timed_call, repeat(_write_model), output_files, manifests)
+
+    written = 0
+    try:
+        for output_file, manifest, (seconds, was_written) in zip(output_files, manifests, results):
+            cache.record('vmdl', output_file, [], manifest)
+            metrics.file_done('vmdl', output_file, seconds, written=was_written)
+            if was_written:
+                metrics.log(f"Generated {output_file}")
+            written += was_written
+    finally:
+        if executor:
+            executor.shutdown()
+        cache.save()
+
+    print(f"Wrote {written} .vmdl files, {len(subtrees) - 1 - written} were unchanged.")
+
+
+def update_models(directory: str, changed_paths: list, addon_directory: str = None):
+    """
+    Regenerate only the models of the folders containing the given .fbx files, e.g. after they were added, changed
+    or removed. Every folder between the directory and a file has its own model, see traverse_and_generate_models.
+    The models of folders that no longer contain any .fbx file are removed.
+
+    :param directory: The directory containing the subdirectories with .fbx files.
+    :param changed_paths: The paths to the changed .fbx files below the directory.
+    :param addon_directory: The root directory of the addon, e.g. content/csgo_addons/<addon>.
+    """
+    cache = BuildCache.for_directory(directory, 'vmdl')
+    model_directories = set()
+    for path in changed_paths:
+        parts = os.path.relpath(os.path.dirname(path), directory).replace("\\", "/").split("/")
+        if parts[0] in (os.curdir, os.pardir):
+            continue
+        model_directories.update(os.path.join(directory, *parts[:depth]) for depth in range(1, len(parts) + 1))
+
+    try:
+        for subdir_path in sorted(model_directories):
+            parent_dir, subdir = os.path.split(subdir_path)
             output_file = os.path.join(parent_dir, f"detail_model_{subdir}.vmdl")
-            generate_modeldoc(subdir_path, output_file)
+            fbx_files = _collect_fbx_files(subdir_path, {}) if os.path.isdir(subdir_path) else []
+            if not fbx_files:
+                # The folder or its last .fbx file was removed, so its model would only reference missing meshes
+                cache.forget('vmdl', output_file)
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                    print(f"Removed {output_file}")
+                continue
+            manifest = [[get_addon_relative_path(path, addon_directory), mtime_ns] for path, mtime_ns in fbx_files]
+            if cache.is_fresh('vmdl', output_file, [], manifest, outputs=[output_file]):
+                continue
+            seconds, was_written = timed_call(_write_model, output_file, manifest)
+            cache.record('vmdl', output_file, [], manifest)
+            metrics.file_done('vmdl', output_file, seconds, written=was_written)
+            if was_written:
+                print(f"Updated {output_file}")
+    finally:
+        cache.save()
 
 
-def generate_modeldoc(directory: str, output_file: str):
+def generate_modeldoc(directory: str, output_file: str, addon_directory: str = None):
     if not os.path.isdir(directory):
         raise ValueError(f"The directory {directory} does not exist.")
 
-    fbx_files = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.fbx'):
-                full_path = os.path.join(root, file)
-                relative_path = full_path.split("csgo_addons", 1)[1]
-                relative_path = relative_path.split("\\", 1)[1]
-                relative_path = relative_path.lstrip("/\\")
-                relative_path = relative_path.split("\\", 1)
-                relative_path = relative_path[1]
-                fbx_files.append(relative_path.lstrip('/\\'))
-
+    fbx_files = _collect_fbx_files(directory, {})
     if not fbx_files:
         raise ValueError(f"No .fbx files found in the directory {directory}.")
 
-    base_structure = """
-    {{
-        rootNode = 
-        {{
-            _class = "RootNode"
-            children = 
-            [
-                {{
-                    _class = "RenderMeshList"
-                    children = 
-                    [
-                        {RENDER_MESH_FILES}
-                    ]
-                }}
-            ]
-            model_archetype = ""
-            primary_associated_entity = ""
-            anim_graph_name = ""
-            document_sub_type = "ModelDocSubType_None"
-        }}
-    }}
+    write_modeldoc(output_file, [get_addon_relative_path(path, addon_directory) for path, _ in fbx_files])
+
+
+def get_addon_relative_path(path: str, addon_directory: str = None) -> str:
     """
+    Get the path of a file relative to its addon directory, using forward slashes on every platform.
 
-    render_mesh_file_template = """
-                    {{
-                        _class = "RenderMeshFile"
-                        filename = "{filename}"
-                        import_scale = 1.0
-                        import_filter = 
-                        {{
-                            exclude_by_default = false
-                            exception_list = [  ]
-                        }}
-                    }}
+    :param path: The path to the file.
+    :param addon_directory: The root directory of the addon. If None, it is the directory directly below the
+                            csgo_addons folder in the path.
+    :return: The relative path.
     """
+    if addon_directory is not None:
+        return os.path.relpath(path, addon_directory).replace("\\", "/")
+
+    parts = os.path.abspath(path).replace("\\", "/").split("/")
+    if "csgo_addons" not in parts:
+        raise ValueError(f"The path {path} is not inside a csgo_addons directory.")
+    return "/".join(parts[parts.index("csgo_addons") + 2:])
+
+
+def _collect_fbx_files(directory: str, subtrees: dict) -> list:
+    """
+    Collect the .fbx files below a directory in one pass, storing the list for every directory in subtrees.
+
+    :return: A list of (path, mtime_ns) tuples.
+    """
+    with os.scandir(directory) as scanned:
+        entries = sorted(scanned, key=lambda entry: entry.name)
+
+    fbx_files = [(entry.path, entry.stat().st_mtime_ns) for entry in entries
+                 if entry.name.endswith('.fbx') and entry.is_file()]
+    subtrees[directory] = fbx_files
+    for entry in entries:
+        if entry.is_dir():
+            fbx_files.extend(_collect_fbx_files(entry.path, subtrees))
+    return fbx_files
 
-    render_mesh_files = ""
-    for fbx_file in fbx_files:
-        render_mesh_files += render_mesh_file_template.format(filename=f'{fbx_file.replace("\\", "/")}') + ","
 
-    render_mesh_files = render_mesh_files.rstrip(',')
+def _write_model(output_file: str, manifest: list) -> bool:
+    return write_modeldoc(output_file, [path for path, _ in manifest])
 
-    final_structure = base_structure.replace("{RENDER_MESH_FILES}", render_mesh_files)
+
+def write_modeldoc(output_file: str, fbx_files: list) -> bool:
+    """
+    Write a .vmdl file referencing the given .fbx files, unless the file already has exactly that content.
+
+    :param output_file: The path to the .vmdl file.
+    :param fbx_files: The paths of the .fbx files relative to the addon directory.
+    :return: True if the file was written.
+    """
+    content = io.StringIO()
+    _render_modeldoc(content, fbx_files)
+    content = content.getvalue()
+
+    if os.path.exists(output_file):
+        with open(output_file, 'r') as f:
+            if f.read() == content:
+                return False
 
     with open(output_file, 'w') as f:
-        f.write(
-            "<!-- kv3 encoding:text:version{e21c7f3c-8a33-41c5-9977-a76d3a32aa0d} format:modeldoc36:version{972dada4-b828-45a4-bb93-7795cf0585da} -->\n")
-        f.write(final_structure.replace("{{", "{").replace("}}", "}"))
+        f.write(content)
+    metrics.count('write', size=len(content.encode()))
+    return True
+
+
+def _render_modeldoc(file, fbx_files: list):
+    writer = KV3Writer(file)
+    writer.write_header()
+    writer.begin_object()
+    writer.begin_object('rootNode')
+    writer.write_value('_class', 'RootNode')
+    writer.begin_array('children')
+    writer.begin_object()
+    writer.write_value('_class', 'RenderMeshList')
+    writer.begin_array('children')
+    for fbx_file in fbx_files:
+        writer.begin_object()
+        writer.write_value('_class', 'RenderMeshFile')
+        writer.write_value('filename', fbx_file)
+        writer.write_value('import_scale', 1.0)
+        writer.begin_object('import_filter')
+        writer.write_value('exclude_by_default', False)
+        writer.write_value('exception_list', [])
+        writer.end_object()
+        writer.end_object()
+    writer.end_array()
+    writer.end_object()
+    writer.end_array()
+    writer.write_value('model_archetype', '')
+    writer.write_value('primary_associated_entity', '')
+    writer.write_value('anim_graph_name', '')
+    writer.write_value('document_sub_type', 'ModelDocSubType_None')
+    writer.end_object()
+    writer.end_object()
+    writer.finish()
@@ -1,30 +1,186 @@
 import os
 import json
-import shutil
+import hashlib
+import io
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image, ImageOps
+from build_cache import BuildCache
+from copy_engine import CopyEngine
+from image_cache import disable_in_worker, image_cache
+from kv3_writer import quote
+from metrics import metrics, timed_call
+from png_encoding import BINARY_LUT
+
+# Digest of a translucency map to its encoded .png file, so that identical maps are only encoded once per process
+_encoded_maps = {}
+_MAX_ENCODED_MAPS = 256
+
+
+def generate_translucency_map(color_path):
+    """
+    Generate the binary translucency map of a color texture in memory. This does not touch any TextureSetFinder
+    state, so it can run in a worker process. Maps identical to one already generated in the same process reuse its
+    encoded bytes instead of being encoded again.
+
+    :return: A (trans_path, data, reused, error) tuple, where data is the encoded .png file and reused tells whether
+             it was taken from an identical map instead of being encoded. trans_path is None if the map is fully
+             black or could not be created.
+    """
+    try:
+        # Images without any transparency are never decoded, their header tells enough
+        with Image.open(color_path) as img:
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            size = img.size
+        if has_alpha:
+            img = image_cache.load(color_path)
+            alpha = img.getchannel("A") if "A" in img.getbands() else img.convert("RGBA").getchannel("A")
+        else:
+            alpha = None
+
+        lowest, highest = alpha.getextrema() if alpha else (255, 255)
+
+        # Check if the map would be fully black
+        if highest == 0:
+            return None, None, False, None  # Fully black, no need to create the file
+
+        # Create the binary translucency map, which is fully white if no pixel is fully transparent
+        if lowest > 0:
+            trans_img = Image.new("L", size, 255)
+            digest = f"{size[0]}x{size[1]}:white"
+        else:
+            trans_img = alpha.point(BINARY_LUT)
+            digest = f"{size[0]}x{size[1]}:{hashlib.sha256(trans_img.tobytes()).hexdigest()}"
+
+        data = _encoded_maps.get(digest)
+        reused = data is not None
+        if not reused:
+            buffer = io.BytesIO()
+            trans_img.save(buffer, format="PNG")
+            data = buffer.getvalue()
+            if len(_encoded_maps) < _MAX_ENCODED_MAPS:
+                _encoded_maps[digest] = data
+        trans_path = os.path.splitext(color_path)[0] + '_trans.png'
+        return trans_path, data, reused, None
+    except Exception as e:
+        return None, None, False, f"Failed to generate translucency map for {color_path}: {e}"
+
+
+def _run(executor, fn, *args):
+    """Submit fn to the executor, or run it right away and wrap the outcome in a future if there is none."""
+    if executor:
+        return executor.submit(fn, *args)
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 
 class TextureSetFinder:
-    def __init__(self, input_dir, output_dir):
+    def __init__(self, input_dir, output_dir, force=False, workers=1, link_mode='reflink'):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.texture_set_keys = set()  # Set to store unique keys
-
+        self.unresolved_textures = set()  # Texture references that did not match any file
+        self._directory_index = {}  # Directory path to the names of its entries, each listed only once
+        self._resolved_paths = {}  # (subdir, texture name) to the completed texture path
+        # Build cache of processed texture sets, ignored when force is set
+        self.cache = BuildCache.for_directory(output_dir, 'pbr', force)
+        # With more than one worker, translucency maps are generated in a process pool and files are copied in a
+        # thread pool, while JSON parsing and writing the .vmat files stay on the calling thread
+        self.workers = workers
+        self._image_executor = None
+        self._copy_executor = None
+        self._translucency_futures = {}  # Color texture path to the future of its translucency map
+        self._copy_futures = {}  # Destination path to the future of its copy
+        # Skips up-to-date copies and links instead of copying where the filesystem supports it
+        self.copy_engine = CopyEngine(link_mode)
+        self.deduplicated_translucency_maps = 0
+
+    @metrics.timed('pbr')
     def find_texture_sets(self):
+        max_pending = self.workers * 4 if self.workers > 1 else 0
+        pending = deque()  # Texture sets waiting for their translucency map
+        copying = deque()  # Texture sets waiting for their copies before being recorded in the cache
+
+        if self.workers > 1:
+            self._image_executor = ProcessPoolExecutor(max_workers=self.workers, initializer=disable_in_worker)
+            self._copy_executor = ThreadPoolExecutor(max_workers=self.workers)
+
         # Walk through all subdirectories and files in the input directory
-        for subdir, _, files in os.walk(self.input_dir):
-            for file in files:
-                # Check if the file ends with '_set.json'
-                if file.endswith('_set.json'):
-                    file_path = os.path.join(subdir, file)
-                    self._process_file(file_path, subdir)
+        try:
+            for subdir, dirs, files in os.walk(self.input_dir):
+                dirs.sort()
+                for file in sorted(files):
+                    # Check if the file ends with '_set.json'
+                    if file.endswith('_set.json'):
+                        file_path = os.path.join(subdir, file)
+                        job = self._process_file(file_path, subdir)
+                        if job:
+                            pending.append(job)
+                        while len(pending) > max_pending:
+                            copying.append(self._finish_texture_set(*pending.popleft()))
+                        while len(copying) > max_pending:
+                            self._record_texture_set(*copying.popleft())
+            while pending:
+                copying.append(self._finish_texture_set(*pending.popleft()))
+            while copying:
+                self._record_texture_set(*copying.popleft())
+        finally:
+            if self._image_executor:
+                self._image_executor.shutdown()
+                self._copy_executor.shutdown()
+                self._image_executor = self._copy_executor = None
+            self.cache.save()
 
         # Print all unique keys found in the 'minecraft:texture_set' objects
         print("Unique keys found in 'minecraft:texture_set':")
         for key in sorted(self.texture_set_keys):
             print(key)
 
+        print(self.copy_engine.summary())
+
+        if self.deduplicated_translucency_maps:
+            print(f"Reused the encoding of {self.deduplicated_translucency_maps} identical translucency maps")
+
+        if self.unresolved_textures:
+            print(f"{len(self.unresolved_textures)} texture references could not be resolved:")
+            for texture_path in sorted(self.unresolved_textures):
+                print(texture_path)
+
+    def update_texture_sets(self, json_paths):
+        """
+        Process only the given texture sets, e.g. after they or their textures changed. Sets whose JSON and textures
+        match the build cache and sets that no longer exist are skipped.
+
+        :param json_paths: The paths to the *_set.json files below the input directory.
+        """
+        try:
+            for file_path in sorted(json_paths):
+                if not os.path.exists(file_path):
+                    continue
+                job = self._process_file(file_path, os.path.dirname(file_path))
+                if job:
+                    self._record_texture_set(*self._finish_texture_set(*job))
+                    print(f"Updated the texture set {file_path}")
+        finally:
+            self.cache.save()
+
+    def get_dependent_texture_sets(self, texture_paths):
+        """
+        Get the texture sets recorded in the build cache that were built from any of the given files.
+
+        :param texture_paths: The paths to the files.
+        :return: A set of *_set.json paths.
+        """
+        texture_paths = set(texture_paths)
+        return {json_path for json_path, entry in self.cache.entries.get('texture_set', {}).items()
+                if texture_paths.intersection(entry['inputs'])}
+
     def _process_file(self, file_path, subdir):
+        """Parse a texture set and start generating its translucency map. Returns the job to finish, if any."""
         try:
             # Open and load the JSON file
             with open(file_path, 'r') as json_file:
@@ -32,29 +188,74 @@ class TextureSetFinder:
                 if "minecraft:texture_set" in data:
                     texture_set = data["minecraft:texture_set"]
                     self.texture_set_keys.update(texture_set.keys())
-                    self._create_vmat_file(file_path, texture_set, subdir)
+
+                    # Skip sets whose JSON and textures did not change since the last run
+                    input_files = self._get_input_files(file_path, texture_set, subdir)
+                    output_file_path = self._get_output_file_path(file_path, subdir)
+                    if self.cache.is_fresh('texture_set', file_path, input_files, outputs=[output_file_path]):
+                        metrics.log(f"Skipped {file_path} as it is unchanged")
+                        metrics.count('unchanged')
+                        return None
+
+                    return file_path, texture_set, subdir, input_files, self._start_translucency_map(texture_set,
+                                                                                                     file_path,
+                                                                                                     subdir)
         except json.JSONDecodeError:
             print(f'Error decoding JSON in file: {file_path}')
         except Exception as e:
             print(f'An error occurred while processing the file {file_path}: {e}')
+        return None
+
+    def _start_translucency_map(self, texture_set, json_path, subdir):
+        # Determine the color texture and generate the translucency map from it, once per color texture
+        base_name = os.path.basename(json_path).replace('_set.json', '')
+        color_texture_path = self._complete_texture_path(subdir, texture_set.get("color", f"{base_name}"))
+        if not (color_texture_path and self._file_exists(color_texture_path)):
+            return None
+        if color_texture_path not in self._translucency_futures:
+            self._translucency_futures[color_texture_path] = _run(self._image_executor, timed_call,
+                                                                  generate_translucency_map, color_texture_path)
+            metrics.count('decode')
+        return self._translucency_futures[color_texture_path]
+
+    def _finish_texture_set(self, file_path, texture_set, subdir, input_files, translucency_future):
+        """Copy the textures and write the .vmat file of a texture set once its translucency map is ready."""
+        try:
+            copy_futures = self._create_vmat_file(file_path, texture_set, subdir, translucency_future)
+        except Exception as e:
+            print(f'An error occurred while processing the file {file_path}: {e}')
+            copy_futures = None
+        return file_path, input_files, copy_futures
+
+    def _record_texture_set(self, file_path, input_files, copy_futures):
+        if copy_futures is None:
+            return
+        try:
+            for future in copy_futures:
+                future.result()
+        except Exception as e:
+            print(f'An error occurred while processing the file {file_path}: {e}')
+            return
+        self.cache.record('texture_set', file_path, input_files)
 
-    def _create_vmat_file(self, json_path, texture_set, subdir):
+    def _create_vmat_file(self, json_path, texture_set, subdir, translucency_future):
         # Extract the base name without _set.json
         base_name = os.path.basename(json_path).replace('_set.json', '')
 
         # Prepare a list to hold paths of all textures to copy
         textures_to_copy = []
 
-        # Determine the color texture and generate the translucency map from it
+        # Determine the color texture and take the translucency map generated from it
         color_texture = texture_set.get("color", f"{base_name}")
         color_texture_path = self._complete_texture_path(subdir, color_texture)
         translucency_path = None
+        seconds = None
 
-        if color_texture_path and os.path.exists(color_texture_path):
+        if translucency_future:
             textures_to_copy.append(color_texture_path)
 
-            # Generate the translucency map only from the color texture
-            translucency_path = self._generate_translucency_map(color_texture_path)
+            seconds, translucency_map = translucency_future.result()
+            translucency_path = self._write_translucency_map(*translucency_map)
             if translucency_path:
                 textures_to_copy.append(translucency_path)
 
@@ -62,7 +263,7 @@ class TextureSetFinder:
         for key, texture in texture_set.items():
             if key != "color":  # Skip the color texture, already handled
                 texture_path = self._complete_texture_path(subdir, texture)
-                if texture_path and os.path.exists(texture_path):
+                if texture_path and self._file_exists(texture_path):
                     textures_to_copy.append(texture_path)
 
         # Maintain the relative directory structure in the output
@@ -71,7 +272,7 @@ class TextureSetFinder:
         os.makedirs(output_dir_path, exist_ok=True)
 
         # Copy the texture files to the output directory
-        self._copy_texture_files(textures_to_copy, output_dir_path)
+        copy_futures = self._copy_texture_files(textures_to_copy, output_dir_path)
 
         # Convert paths to relative paths for VMAT content
         rel_textures = {
@@ -87,44 +288,94 @@ class TextureSetFinder:
             os.path.relpath(translucency_path, self.input_dir).replace("\\", "/") if translucency_path else None
         )
 
-        output_file_path = os.path.join(output_dir_path, f"{"pbr_" + base_name}.vmat")
+        output_file_path = self._get_output_file_path(json_path, subdir)
+
+        with open(output_file_path, 'w') as vmat_file:
+            vmat_file.write(vmat_content)
+        metrics.count('write', size=len(vmat_content.encode()))
+        metrics.file_done('pbr', json_path, seconds)
+        metrics.log(f"Generated {output_file_path}")
+        return copy_futures
+
+    def _write_translucency_map(self, trans_path, data, reused, error):
+        """
+        Write a generated translucency map next to its color texture. Every texture set references its own map, even
+        if an identical one was already written, since the build cache only tracks the textures of the set itself.
+        """
+        if error:
+            print(error)
+        if trans_path is None:
+            return None
+        # Each worker process reuses the encodings it made itself, so only the worker knows what it encoded
+        if reused:
+            self.deduplicated_translucency_maps += 1
+        else:
+            metrics.count('encode')
+
+        with open(trans_path, 'wb') as trans_file:
+            trans_file.write(data)
+        metrics.count('write', size=len(data))
+        self._add_to_index(trans_path)
+        return trans_path
+
+    def _get_output_file_path(self, json_path, subdir):
+        base_name = os.path.basename(json_path).replace('_set.json', '')
+        relative_output_dir = os.path.relpath(subdir, self.input_dir)
+        output_file_path = os.path.join(self.output_dir, relative_output_dir, f"{"pbr_" + base_name}.vmat")
 
         # Check if the file path ends with ".texture.vmat" and replace if necessary
         if output_file_path.endswith(".texture.vmat"):
             output_file_path = output_file_path.replace(".texture.vmat", ".vmat")
+        return output_file_path
 
-        with open(output_file_path, 'w') as vmat_file:
-            vmat_file.write(vmat_content)
-        print(f"Generated {output_file_path}")
+    def _get_input_files(self, json_path, texture_set, subdir):
+        """Get the JSON file and all existing texture files a texture set is built from."""
+        input_files = [json_path]
+        base_name = os.path.basename(json_path).replace('_set.json', '')
+        for texture in {texture_set.get("color", base_name), *texture_set.values()}:
+            texture_path = self._complete_texture_path(subdir, texture)
+            if self._file_exists(texture_path):
+                input_files.append(texture_path)
+        return sorted(set(input_files))
 
     def _complete_texture_path(self, subdir, texture_name):
         """Ensure that the texture path has the correct file extension."""
-        texture_path = os.path.join(subdir, texture_name)
-        if not os.path.exists(texture_path):
-            if os.path.exists(f"{texture_path}.tga"):
-                return f"{texture_path}.tga"
-            elif os.path.exists(f"{texture_path}.png"):
-                return f"{texture_path}.png"
-        return texture_path
-
-    def _generate_translucency_map(self, color_path):
-        try:
-            img = Image.open(color_path).convert("RGBA")
-            alpha = img.getchannel("A")
-
-            # Create the binary translucency map
-            trans_img = Image.eval(alpha, lambda a: 255 if a > 0 else 0)
-
-            # Check if the image is fully black
-            if trans_img.getextrema() == (0, 0):
-                return None  # Fully black, no need to create the file
-
-            trans_path = color_path.replace('.png', '_trans.png')
-            trans_img.save(trans_path)
-            return trans_path
-        except Exception as e:
-            print(f"Failed to generate translucency map for {color_path}: {e}")
-            return None
+        key = (subdir, texture_name)
+        if key not in self._resolved_paths:
+            texture_path = os.path.join(subdir, texture_name)
+            if not self._file_exists(texture_path):
+                if self._file_exists(f"{texture_path}.tga"):
+                    texture_path = f"{texture_path}.tga"
+                elif self._file_exists(f"{texture_path}.png"):
+                    texture_path = f"{texture_path}.png"
+                else:
+                    self.unresolved_textures.add(texture_path)
+            self._resolved_paths[key] = texture_path
+        return self._resolved_paths[key]
+
+    def _list_directory(self, directory):
+        """
+        Get the names of all entries in a directory, scanning each directory only once. Paths and names are keyed
+        with os.path.normcase, so that lookups ignore the case on Windows as the file system does.
+        """
+        directory = os.path.normcase(os.path.normpath(directory))
+        if directory not in self._directory_index:
+            try:
+                with os.scandir(directory) as entries:
+                    self._directory_index[directory] = {os.path.normcase(entry.name) for entry in entries}
+            except OSError:
+                self._directory_index[directory] = set()
+        return self._directory_index[directory]
+
+    def _file_exists(self, file_path):
+        """Check whether a file exists using the directory index instead of a stat call."""
+        directory, name = os.path.split(file_path)
+        return os.path.normcase(name) in self._list_directory(directory or os.curdir)
+
+    def _add_to_index(self, file_path):
+        """Add a file created during the run to the directory index."""
+        directory, name = os.path.split(file_path)
+        self._list_directory(directory or os.curdir).add(os.path.normcase(name))
 
     def _generate_vmat_content(self, base_name, color_texture, heightmap_normal, metalness_emissive_roughness,
                                translucency_path):
@@ -149,15 +400,15 @@ Layer0
     //---- PBR 1 ----
     g_vLayer1Tint "[1.000000 1.000000 1.000000 0.000000]"
     TextureLayer1AmbientOcclusion "materials/default/default_ao.tga"
-    TextureLayer1Color "{color_texture}"
-    TextureLayer1Normal "{heightmap_normal}"
-    TextureLayer1Roughness "{metalness_emissive_roughness}"
+    TextureLayer1Color {quote(color_texture)}
+    TextureLayer1Normal {quote(heightmap_normal)}
+    TextureLayer1Roughness {quote(metalness_emissive_roughness)}
 """
         if translucency_path:
             vmat_template += f"""
     //---- Translucent ----
     F_TRANSLUCENT 1
-    TextureLayer1Translucency "{translucency_path}"
+    TextureLayer1Translucency {quote(translucency_path)}
 """
         vmat_template += """
     //---- Texture Address Mode ----
@@ -198,9 +449,20 @@ Layer0
         return vmat_template
 
     def _copy_texture_files(self, file_paths, output_dir_path):
+        """Start copying the files to the output directory, each destination only once. Returns the copy futures."""
+        copy_futures = []
         for file_path in file_paths:
-            if file_path and os.path.exists(file_path):
-                os.path.relpath(file_path, self.input_dir)
+            if file_path and self._file_exists(file_path):
                 destination_path = os.path.join(output_dir_path, os.path.basename(file_path))
-                shutil.copy2(file_path, destination_path)
-                print(f"Copied {file_path} to {destination_path}")
+                if destination_path not in self._copy_futures:
+                    self._copy_futures[destination_path] = _run(self._copy_executor, self._copy_file, file_path,
+                                                                destination_path)
+                copy_futures.append(self._copy_futures[destination_path])
+        return copy_futures
+
+    def _copy_file(self, file_path, destination_path):
+        result = self.copy_engine.copy(file_path, destination_path)
+        if result in ('copied', 'reflinked', 'hardlinked'):
+            metrics.log(f"{result.capitalize()} {file_path} to {destination_path}")
+        else:
+            metrics.log(f"Skipped copying {file_path} to {destination_path} as it is {result}")
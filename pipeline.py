@@ -0,0 +1,143 @@
+import json
+import time
+import contextlib
+import importlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import metrics, profile
+
+
+def _run_pbr(input_dir, output_dir, **options):
+    finder_class = getattr(importlib.import_module('pbr_texture_creator'), 'TextureSetFinder')
+    finder_class(input_dir, output_dir, **options).find_texture_sets()
+
+
+# Stage name to (module, function, stages it depends on, whether it accepts force). The modules are only imported
+# when the stage runs.
+STAGES = {
+    'scale': ('image_scaling', 'scale_images_in_directory', (), True),
+    'vmat': ('vmat_writer', 'create_vmat_files', ('scale',), True),
+    'pbr': (__name__, '_run_pbr', (), True),
+    'split': ('fbx_splitter', 'create_subdirectories_with_files', (), False),
+    'vmdl': ('model_writer', 'traverse_and_generate_models', ('split',), True),
+}
+
+
+def load_config(config_path):
+    """
+    Load a pipeline config file.
+
+    The config is a JSON object with a "stages" object, mapping each stage to run to the keyword arguments of its
+    function. A stage may list the stages it waits for in "depends_on", which replaces its default dependencies.
+
+    :param config_path: The path to the config file.
+    :return: A dict mapping stage names to their options.
+    """
+    with open(config_path, 'r') as config_file:
+        config = json.load(config_file)
+
+    stages = config.get('stages', {})
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages in {config_path}: {', '.join(sorted(unknown))}. "
+                         f"Known stages are {', '.join(STAGES)}.")
+    return stages
+
+
+def get_dependencies(stages):
+    """
+    Get the stages each configured stage waits for. Default dependencies on stages that are not configured are
+    dropped, explicit ones are kept and must be configured.
+
+    :param stages: A dict mapping stage names to their options.
+    :return: A dict mapping stage names to sets of stage names.
+    """
+    dependencies = {}
+    for name, options in stages.items():
+        if 'depends_on' in options:
+            depends_on = set(options['depends_on'])
+            missing = depends_on - set(stages)
+            if missing:
+                raise ValueError(f"Stage {name} depends on stages that are not configured: {', '.join(missing)}.")
+        else:
+            depends_on = {dependency for dependency in STAGES[name][2] if dependency in stages}
+        dependencies[name] = depends_on
+
+    # Reject cycles, which would otherwise leave the pipeline waiting forever
+    resolved = set()
+    while len(resolved) < len(dependencies):
+        ready = {name for name, depends_on in dependencies.items() if name not in resolved and depends_on <= resolved}
+        if not ready:
+            raise ValueError(f"The stage dependencies contain a cycle: {', '.join(sorted(set(stages) - resolved))}.")
+        resolved |= ready
+    return dependencies
+
+
+def run_stage(name, options, force=False, profile_mode=None):
+    module_name, function_name, _, accepts_force = STAGES[name]
+    function = getattr(importlib.import_module(module_name), function_name)
+    kwargs = {key: value for key, value in options.items() if key != 'depends_on'}
+    if force and accepts_force:
+        kwargs['force'] = True
+    with profile(name, profile_mode) if profile_mode else contextlib.nullcontext():
+        function(**kwargs)
+
+
+def run_pipeline(stages, force=False, profile_stage=None, profile_mode='cprofile'):
+    """
+    Run the configured stages, each as soon as the stages it depends on have finished, with independent stages
+    running at the same time. Stages whose dependencies failed are skipped. The time of each stage is printed at
+    the end.
+
+    :param stages: A dict mapping stage names to their options.
+    :param force: Whether to pass force=True to the stages that support it, to ignore their build caches.
+    :param profile_stage: The name of a stage to profile, see metrics.profile.
+    :param profile_mode: 'cprofile' or 'tracemalloc'.
+    :return: A dict mapping stage names to (status, seconds) tuples, status being 'ok', 'failed' or 'skipped'.
+    """
+    dependencies = get_dependencies(stages)
+
+    # The stages run in threads and may start process pools, and forking a process while other threads hold locks
+    # can deadlock the child, so use a fork server where fork would be the default
+    if multiprocessing.get_start_method() == 'fork' and 'forkserver' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('forkserver', force=True)
+
+    results = {}
+    running = {}  # Future to (stage name, start time)
+
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        while len(results) < len(stages):
+            started = {name for name, _ in running.values()}
+            for name, depends_on in dependencies.items():
+                if name in results or name in started:
+                    continue
+                finished = [results[dependency][0] for dependency in depends_on if dependency in results]
+                if any(status != 'ok' for status in finished):
+                    print(f"Skipping stage {name} because a stage it depends on did not succeed")
+                    results[name] = ('skipped', 0.0)
+                elif len(finished) == len(depends_on):
+                    print(f"Starting stage {name}")
+                    stage_profile_mode = profile_mode if name == profile_stage else None
+                    running[executor.submit(run_stage, name, stages[name], force, stage_profile_mode)] = (
+                        name, time.perf_counter())
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, start = running.pop(future)
+                seconds = time.perf_counter() - start
+                try:
+                    future.result()
+                    print(f"Finished stage {name} in {seconds:.2f}s")
+                    results[name] = ('ok', seconds)
+                except Exception as e:
+                    print(f"Stage {name} failed after {seconds:.2f}s: {e}")
+                    results[name] = ('failed', seconds)
+
+    print("Stage timings:")
+    for name in stages:
+        status, seconds = results[name]
+        print(f"  {name:<6} {status:<8} {seconds:.2f}s")
+    print(metrics.summary())
+    return results
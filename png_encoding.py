@@ -0,0 +1,146 @@
+import io
+import os
+from PIL import Image, ImageChops
+from image_cache import image_cache
+
+# Pillow PNG save options per preset. 'palette' is not a Pillow option, it converts images with at most 256 colors
+# to palette images before saving, which is lossless and makes pixel art files a lot smaller.
+PNG_PRESETS = {
+    'default': {},
+    'fast': {'compress_level': 1},
+    'small': {'optimize': True, 'palette': True},
+}
+
+# Lookup table mapping 0 to 0 and every other band value to 255, for the binary translucency masks
+BINARY_LUT = [0] + [255] * 255
+
+
+def get_png_options(preset='default'):
+    """
+    Get the save options of a PNG preset.
+
+    :param preset: The name of a preset in PNG_PRESETS, or a dict of options in the same form.
+    :return: A dict of options.
+    """
+    if isinstance(preset, dict):
+        return dict(preset)
+    if preset not in PNG_PRESETS:
+        raise ValueError(f"Unknown PNG preset {preset}, expected one of {', '.join(PNG_PRESETS)}.")
+    return dict(PNG_PRESETS[preset])
+
+
+def get_preset_params(preset='default'):
+    """
+    Check a preset before any file is touched and get the build cache parameters recording it. The default preset
+    is not recorded, so that files cached before presets existed stay fresh.
+
+    :param preset: The name of a preset in PNG_PRESETS, or a dict of options in the same form.
+    :return: A dict with the preset, or an empty dict for the default preset.
+    """
+    get_png_options(preset)
+    return {'png_preset': preset} if preset != 'default' else {}
+
+
+def save_png(img, destination, preset='default', cache=True):
+    """
+    Save an image as a PNG file with the options of a preset. If the preset converts to a palette, the image is
+    saved as a palette image only if that is actually smaller.
+
+    Images saved to a path are stored in the image cache, unless they were converted to a palette, so the image must
+    not be modified afterwards. See image_cache.ImageCache.
+
+    :param img: The image to save.
+    :param destination: A path or a binary file object.
+    :param preset: The name of a preset in PNG_PRESETS, or a dict of options in the same form.
+    :param cache: Whether to store the image in the image cache, which is not worth it for files no stage reads.
+    """
+    options = get_png_options(preset)
+    is_path = isinstance(destination, (str, os.PathLike))
+    palette_img = to_palette(img) if options.pop('palette', False) else img
+    if palette_img is img:
+        img.save(destination, format="PNG", **options)
+        if cache and is_path:
+            image_cache.store(destination, img)
+        return
+
+    # The palette and its transparency cost a few hundred bytes, which noisy small images may not win back
+    encoded = []
+    for candidate in (palette_img, img):
+        buffer = io.BytesIO()
+        candidate.save(buffer, format="PNG", **options)
+        encoded.append(buffer.getvalue())
+    data = min(encoded, key=len)
+    if is_path:
+        with open(destination, 'wb') as f:
+            f.write(data)
+        if cache and data is encoded[1]:
+            image_cache.store(destination, img)
+    else:
+        destination.write(data)
+
+
+def to_palette(img):
+    """
+    Convert an RGB or RGBA image to a palette image if that loses nothing, i.e. if it has at most 256 colors.
+
+    :param img: The image to convert.
+    :return: The palette image, or the image itself if it is a palette image already or has too many colors.
+    """
+    if img.mode not in ("RGB", "RGBA"):
+        return img
+    colors = img.getcolors(256)
+    if colors is None:
+        return img
+
+    if img.mode == "RGB":
+        palette_img = img.quantize(256, dither=Image.Dither.NONE)
+    else:
+        palette_img = _to_rgba_palette(img, [color for _, color in colors])
+    # The quantizer keeps the exact colors when there are few enough, but check rather than trust that
+    if ImageChops.difference(palette_img.convert(img.mode), img).getbbox(alpha_only=False) is not None:
+        return img
+    return palette_img
+
+
+def _to_rgba_palette(img, colors):
+    # The quantizers do not keep RGBA colors exactly, but they do keep up to 256 RGB colors. So fold the alpha band
+    # into the red and green bands such that the RGBA colors stay distinct, quantize that, and then give every palette
+    # entry the RGBA color it was folded from.
+    for red_factor, green_factor in _FOLD_FACTORS:
+        folded = {_fold(color, red_factor, green_factor): color for color in colors}
+        if len(folded) == len(colors):
+            break
+    else:
+        return img
+
+    red, green, blue, alpha = img.split()
+    red = ImageChops.add_modulo(red, alpha.point([value * red_factor % 256 for value in range(256)]))
+    green = ImageChops.add_modulo(green, alpha.point([value * green_factor % 256 for value in range(256)]))
+    palette_img = Image.merge("RGB", (red, green, blue)).quantize(256, dither=Image.Dither.NONE)
+
+    palette = palette_img.getpalette()
+    palette_img.putpalette(b''.join(bytes(folded.get(tuple(palette[i:i + 3]), (0, 0, 0, 0)))
+                                    for i in range(0, len(palette), 3)), rawmode="RGBA")
+    return palette_img
+
+
+# Factors to try for folding the alpha band into the red and green bands, see _to_rgba_palette
+_FOLD_FACTORS = [(1, 0), (0, 1)] + [(red_factor, green_factor) for red_factor in (3, 37, 101, 197)
+                                     for green_factor in (5, 59, 131, 229)]
+
+
+def _fold(color, red_factor, green_factor):
+    red, green, blue, alpha = color
+    return (red + alpha * red_factor) % 256, (green + alpha * green_factor) % 256, blue
+
+
+def get_integer_factor(size, new_size):
+    """
+    Get the integer factor that scales size to new_size in both directions.
+
+    :return: The factor, or None if there is no such factor.
+    """
+    (width, height), (new_width, new_height) = size, new_size
+    if width and height and new_width % width == 0 and new_width // width == new_height / height:
+        return new_width // width
+    return None
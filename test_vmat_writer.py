@@ -0,0 +1,125 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from PIL import Image
+import vmat_writer
+
+MODES = ('RGBA', 'RGB', 'P', 'LA', 'L', '1')
+
+
+# The per-pixel implementations the band operations replaced, kept as the reference
+def reference_is_fully_white(image_path):
+    with Image.open(image_path) as img:
+        img = img.convert("RGBA")
+        for item in img.getdata():
+            if item[0:3] != (255, 255, 255):
+                return False
+        return True
+
+
+def reference_create_trans_png(source_png_path, trans_png_path):
+    with Image.open(source_png_path) as img:
+        trans_img = img.copy().convert("RGBA")
+        new_data = []
+        for item in trans_img.getdata():
+            if item[0] == 0 and item[1] == 0 and item[2] == 0:
+                new_data.append((0, 0, 0, item[3]))
+            else:
+                new_data.append((255, 255, 255, item[3]))
+        trans_img.putdata(new_data)
+        trans_img.save(trans_png_path)
+
+
+def reference_remove_translucency(png_path):
+    with Image.open(png_path) as img:
+        img = img.convert("RGBA")
+        img.putdata([(item[0], item[1], item[2], 255) for item in img.getdata()])
+        img.save(png_path)
+
+
+def create_texture(path, mode, seed, size=(16, 16)):
+    """Write a texture with random pixels, many of them black, fully transparent or white."""
+    rng = random.Random(seed)
+    values = (0, 0, 0, 255, 255, 1, 128)
+    img = Image.new("RGBA", size)
+    img.putdata([tuple(rng.choice(values) if rng.random() < 0.5 else rng.randrange(256) for _ in range(4))
+                 for _ in range(size[0] * size[1])])
+    if mode == 'P':
+        img = img.convert("RGB").quantize(16)
+        img.info['transparency'] = 0
+    elif mode != 'RGBA':
+        img = img.convert(mode)
+    img.save(path)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class BandOperationsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.textures = []
+        for mode in MODES:
+            for seed in range(3):
+                path = os.path.join(self.directory, f"{mode}_{seed}.png")
+                create_texture(path, mode, seed)
+                self.textures.append(path)
+        # Fully white textures, once opaque and once translucent
+        for name, color in (('white', (255, 255, 255, 255)), ('white_translucent', (255, 255, 255, 0))):
+            path = os.path.join(self.directory, f"{name}.png")
+            Image.new("RGBA", (8, 8), color).save(path)
+            self.textures.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, path, suffix):
+        copy_path = f"{os.path.splitext(path)[0]}_{suffix}.png"
+        shutil.copyfile(path, copy_path)
+        return copy_path
+
+    def test_create_trans_png(self):
+        for path in self.textures:
+            with self.subTest(path=os.path.basename(path)):
+                new_trans_path = f"{os.path.splitext(path)[0]}_new_trans.png"
+                reference_trans_path = f"{os.path.splitext(path)[0]}_reference_trans.png"
+                vmat_writer.create_trans_png(path, new_trans_path)
+                reference_create_trans_png(path, reference_trans_path)
+                self.assertEqual(read_bytes(new_trans_path), read_bytes(reference_trans_path))
+
+    def test_remove_translucency(self):
+        for path in self.textures:
+            with self.subTest(path=os.path.basename(path)):
+                new_path, reference_path = self.copy(path, 'new'), self.copy(path, 'reference')
+                vmat_writer.remove_translucency(new_path)
+                reference_remove_translucency(reference_path)
+                self.assertEqual(read_bytes(new_path), read_bytes(reference_path))
+
+    def test_is_fully_white(self):
+        for path in self.textures:
+            with self.subTest(path=os.path.basename(path)):
+                self.assertEqual(vmat_writer.is_fully_white(path), reference_is_fully_white(path))
+
+    def test_process_texture(self):
+        for path in self.textures:
+            with self.subTest(path=os.path.basename(path)):
+                new_path, reference_path = self.copy(path, 'new'), self.copy(path, 'reference')
+                new_trans_path = f"{os.path.splitext(new_path)[0]}_trans.png"
+                reference_trans_path = f"{os.path.splitext(reference_path)[0]}_trans.png"
+
+                is_transparent, _ = vmat_writer.process_texture(new_path, new_trans_path)
+                # The order of the original create_vmat_files
+                reference_remove_translucency(reference_path)
+                reference_create_trans_png(reference_path, reference_trans_path)
+
+                self.assertEqual(read_bytes(new_path), read_bytes(reference_path))
+                self.assertEqual(read_bytes(new_trans_path), read_bytes(reference_trans_path))
+                self.assertEqual(is_transparent, not reference_is_fully_white(reference_trans_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
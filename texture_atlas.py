@@ -0,0 +1,100 @@
+import math
+from PIL import Image
+from image_cache import image_cache
+
+
+def next_power_of_two(value):
+    return 1 << max(value - 1, 0).bit_length()
+
+
+def pack_rectangles(sizes, max_size=4096, padding=2):
+    """
+    Pack rectangles into power-of-two atlases with a shelf packer. The rectangles are placed tallest first in rows
+    (shelves) of a width chosen from their total area, and a new atlas is started once an atlas would exceed
+    max_size. Every rectangle keeps padding pixels of space on each side.
+
+    :param sizes: A list of (width, height) tuples.
+    :param max_size: The maximum width and height of an atlas, a power of two.
+    :param padding: The space around each rectangle in pixels.
+    :return: A list of ((atlas_width, atlas_height), placements) tuples, where placements maps the index of each
+             rectangle in sizes to the (x, y) position of its top left pixel.
+    """
+    padded = [(width + 2 * padding, height + 2 * padding) for width, height in sizes]
+    if not padded:
+        return []
+    if any(width > max_size or height > max_size for width, height in padded):
+        raise ValueError(f"A rectangle does not fit into an atlas of {max_size}x{max_size} with padding {padding}.")
+
+    total_area = sum(width * height for width, height in padded)
+    widest = max(width for width, _ in padded)
+    shelf_width = min(max_size, next_power_of_two(max(math.isqrt(total_area), widest)))
+
+    atlases = []
+    placements = {}
+    x = y = shelf_height = used_width = 0
+    for index in sorted(range(len(padded)), key=lambda i: (-padded[i][1], -padded[i][0], i)):
+        width, height = padded[index]
+        if x + width > shelf_width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if y + height > max_size:
+            atlases.append(((next_power_of_two(used_width), next_power_of_two(y)), placements))
+            placements = {}
+            x = y = shelf_height = used_width = 0
+        placements[index] = (x + padding, y + padding)
+        x += width
+        shelf_height = max(shelf_height, height)
+        used_width = max(used_width, x)
+    atlases.append(((next_power_of_two(used_width), next_power_of_two(y + shelf_height)), placements))
+    return atlases
+
+
+def paste_with_bleed(atlas, img, position, padding):
+    """
+    Paste an image into an atlas and repeat its edge pixels into the padding around it, so that filtering near the
+    edge of the image does not sample its neighbours.
+
+    :param atlas: The atlas image.
+    :param img: The image to paste, in the mode of the atlas.
+    :param position: The (x, y) position of the top left pixel of the image in the atlas.
+    :param padding: The width of the padding to fill in pixels.
+    """
+    x, y = position
+    width, height = img.size
+    atlas.paste(img, (x, y))
+    if not padding:
+        return
+
+    atlas.paste(img.crop((0, 0, 1, height)).resize((padding, height), Image.NEAREST), (x - padding, y))
+    atlas.paste(img.crop((width - 1, 0, width, height)).resize((padding, height), Image.NEAREST), (x + width, y))
+    # The rows are taken from the atlas so that the corners repeat the corner pixels
+    top = atlas.crop((x - padding, y, x + width + padding, y + 1))
+    atlas.paste(top.resize((width + 2 * padding, padding), Image.NEAREST), (x - padding, y - padding))
+    bottom = atlas.crop((x - padding, y + height - 1, x + width + padding, y + height))
+    atlas.paste(bottom.resize((width + 2 * padding, padding), Image.NEAREST), (x - padding, y + height))
+
+
+def build_atlas_image(image_paths, positions, size, padding, mode="RGBA"):
+    """
+    Build an atlas image from image files.
+
+    :param image_paths: The paths to the images.
+    :param positions: The (x, y) position of each image in the atlas.
+    :param size: The (width, height) of the atlas.
+    :param padding: The width of the bleed around each image in pixels.
+    :param mode: The mode of the atlas image.
+    :return: The atlas image.
+    """
+    atlas = Image.new(mode, size)
+    for image_path, position in zip(image_paths, positions):
+        paste_with_bleed(atlas, image_cache.load(image_path).convert(mode), position, padding)
+    return atlas
+
+
+def get_uv_rect(position, image_size, atlas_size):
+    """
+    Get the UV rectangle of an image in an atlas, with v measured from the top of the atlas.
+
+    :return: A [u_min, v_min, u_max, v_max] list.
+    """
+    (x, y), (width, height), (atlas_width, atlas_height) = position, image_size, atlas_size
+    return [x / atlas_width, y / atlas_height, (x + width) / atlas_width, (y + height) / atlas_height]
@@ -1,5 +1,21 @@
+import argparse
+import hashlib
+import json
 import os
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from PIL import Image, ImageChops
+from build_cache import BuildCache
+from image_cache import disable_in_worker, image_cache
+from kv3_writer import quote
+from metrics import metrics, timed_call
+from png_encoding import BINARY_LUT, PNG_PRESETS, get_preset_params, save_png
+from texture_atlas import pack_rectangles, build_atlas_image, get_uv_rect
+
+# The folder below the source directory the atlas images are written to, which is never scanned for textures
+ATLAS_DIRECTORY = '_atlas'
+UV_REMAP_NAME = 'atlas_uv_remap.json'
+ALIASES_NAME = 'material_aliases.json'
 
 
 def generate_vmat_content(png_relative_path, trans_relative_path, is_transparent=False):
@@ -35,10 +51,10 @@ Layer0
     //---- PBR 1 ----
     g_vLayer1Tint "[1.000000 1.000000 1.000000 0.000000]"
     TextureLayer1AmbientOcclusion "materials/default/default_ao.tga"
-    TextureLayer1Color "{png_relative_path}"
+    TextureLayer1Color {quote(png_relative_path)}
     TextureLayer1Normal "[0.501961 0.501961 1.000000 0.000000]"
     TextureLayer1Roughness "materials/default/default_rough.tga"
-    TextureLayer1Translucency "{trans_relative_path}"
+    TextureLayer1Translucency {quote(trans_relative_path)}
 
     //---- Texture Address Mode ----
     g_nTextureAddressModeU "0" // Wrap
@@ -97,7 +113,7 @@ Layer0
     //---- PBR 1 ----
     g_vLayer1Tint "[1.000000 1.000000 1.000000 0.000000]"
     TextureLayer1AmbientOcclusion "materials/default/default_ao.tga"
-    TextureLayer1Color "{png_relative_path}"
+    TextureLayer1Color {quote(png_relative_path)}
     TextureLayer1Normal "materials/default/default_normal.tga"
     TextureLayer1Roughness "materials/default/default_rough.tga"
 
@@ -139,14 +155,24 @@ def is_fully_white(image_path):
     :param image_path: The path to the image file.
     :return: True if the image is fully white, False otherwise.
     """
-    with Image.open(image_path) as img:
-        img = img.convert("RGBA")
-        data = img.getdata()
+    img = image_cache.load(image_path).convert("RGBA")
+    # The RGB bands are fully white exactly when each band's minimum is 255
+    return all(band_min == 255 for band_min, _ in img.getextrema()[:3])
 
-        for item in data:
-            if item[0:3] != (255, 255, 255):  # Check if the RGB values are not all white
-                return False
-        return True
+
+def build_trans_image(img):
+    """
+    Build the translucency image for an already decoded RGBA image.
+
+    :param img: The RGBA image to derive the translucency image from.
+    :return: The translucency image, white where the color is not black and black elsewhere.
+    """
+    red, green, blue, alpha = img.split()
+
+    # A pixel is black only if all three color bands are zero, so threshold the per-pixel maximum
+    mask = ImageChops.lighter(ImageChops.lighter(red, green), blue).point(BINARY_LUT)
+
+    return Image.merge("RGBA", (mask, mask, mask, alpha))
 
 
 def create_trans_png(source_png_path, trans_png_path):
@@ -155,20 +181,8 @@ def create_trans_png(source_png_path, trans_png_path):
     :param source_png_path: The path to the original .png file.
     :param trans_png_path: The path to the _trans.png file to be created.
     """
-    with Image.open(source_png_path) as img:
-        trans_img = img.copy()
-        trans_img = trans_img.convert("RGBA")
-        data = trans_img.getdata()
-
-        new_data = []
-        for item in data:
-            if item[0] == 0 and item[1] == 0 and item[2] == 0:
-                new_data.append((0, 0, 0, item[3]))
-            else:
-                new_data.append((255, 255, 255, item[3]))
-
-        trans_img.putdata(new_data)
-        trans_img.save(trans_png_path)
+    trans_img = build_trans_image(image_cache.load(source_png_path).convert("RGBA"))
+    trans_img.save(trans_png_path)
 
 
 def remove_translucency(png_path):
@@ -176,78 +190,512 @@ def remove_translucency(png_path):
     Remove any translucency information from the .png file.
     :param png_path: The path to the .png file to be modified.
     """
-    with Image.open(png_path) as img:
-        img = img.convert("RGBA")
-        data = img.getdata()
+    img = image_cache.load(png_path).convert("RGBA")
+    img.putalpha(255)
+    img.save(png_path)
 
-        new_data = []
-        for item in data:
-            new_data.append((item[0], item[1], item[2], 255))
 
-        img.putdata(new_data)
-        img.save(png_path)
+def process_texture(png_path, trans_png_path, png_preset='default'):
+    """
+    Remove the translucency from the .png file and create its _trans.png file from a single decode.
 
+    This produces the same files as calling remove_translucency, create_trans_png and is_fully_white
+    one after another, but only decodes the source once and never re-reads what it just wrote.
+    An existing _trans.png is left untouched and only decoded to check whether it is fully white.
 
-def create_vmat_files(source_directory, target_directory):
+    :param png_path: The path to the .png file to be modified.
+    :param trans_png_path: The path to the _trans.png file to be created.
+    :param png_preset: The name of a preset in png_encoding.PNG_PRESETS to save both files with.
+    :return: A tuple of (is_transparent, trans_created).
     """
-    Traverse the source directory to find .png files and create corresponding .vmat files in the target directory.
+    img = image_cache.load(png_path).convert("RGBA")
+    img.putalpha(255)
+    save_png(img, png_path, png_preset)
 
-    :param source_directory: The directory containing the .png files.
-    :param target_directory: The directory where the .vmat files will be created.
+    if os.path.exists(trans_png_path):
+        return not is_fully_white(trans_png_path), False
+
+    trans_img = build_trans_image(img)
+    save_png(trans_img, trans_png_path, png_preset)
+
+    # The mask is fully white exactly when its minimum is 255
+    return trans_img.getchannel("R").getextrema()[0] != 255, True
+
+
+def get_vmat_filename(relative_png_path):
     """
-    os.makedirs(target_directory, exist_ok=True)
+    Get the name of the .vmat file for a .png file, prefixed with its subfolders below the tex folder.
+
+    :param relative_png_path: The relative path to the .png file from the root directory, using forward slashes.
+    :return: The .vmat file name.
+    """
+    try:
+        parts = relative_png_path.split('/tex/')
+        if len(parts) > 1:
+            subfolders = parts[1].rsplit('/', 1)[0]
+            prefix = f"{subfolders.replace('/', '_')}_"
+        else:
+            prefix = ''
+    except IndexError:
+        prefix = ''
+
+    if prefix.endswith('_'):
+        prefix = prefix[:-1] + '-'
+
+    vmat_filename = prefix + os.path.splitext(os.path.basename(relative_png_path))[0] + '.vmat'
+
+    if vmat_filename.startswith("jmc2obj_banner_"):
+        vmat_filename = vmat_filename.replace("jmc2obj_banner_", "jmc2obj_banner-banner_")
+
+    if vmat_filename.startswith("minecraft_entity_"):
+        vmat_filename = vmat_filename.replace("minecraft_entity_", "minecraft_entity-")
+
+    vmat_filename = vmat_filename.replace("player_wide-steve", "player-wide-steve")
 
-    for root, _, files in os.walk(source_directory):
-        for file in files:
+    return vmat_filename
+
+
+def find_textures(source_directory):
+    """
+    Find all .png files in the source directory that are not _trans.png files, in a deterministic order.
+
+    :param source_directory: The directory containing the .png files.
+    :return: A list of (full_png_path, trans_png_filepath, relative_png_path) tuples.
+    """
+    textures = []
+    for root, dirs, files in os.walk(source_directory):
+        if root == source_directory and ATLAS_DIRECTORY in dirs:
+            dirs.remove(ATLAS_DIRECTORY)
+        dirs.sort()
+        for file in sorted(files):
             if file.lower().endswith('.png') and not file.lower().endswith('_trans.png'):
                 full_png_path = os.path.join(root, file)
                 relative_png_path = os.path.relpath(full_png_path, source_directory)
                 relative_png_path = relative_png_path.replace('\\', '/')
 
-                remove_translucency(full_png_path)
-                print(f"Translucency removed from {full_png_path}")
-
                 trans_png_filename = os.path.splitext(file)[0] + '_trans.png'
                 trans_png_filepath = os.path.join(root, trans_png_filename)
 
-                if not os.path.exists(trans_png_filepath):
-                    create_trans_png(full_png_path, trans_png_filepath)
-                    print(f"Created {trans_png_filepath}")
+                textures.append((full_png_path, trans_png_filepath, relative_png_path))
+    return textures
+
 
-                is_transparent = not is_fully_white(trans_png_filepath)
+@metrics.timed('vmat')
+def create_vmat_files(source_directory, target_directory, workers=1, force=False, atlas=False, atlas_size=4096,
+                      atlas_padding=2, dedupe=False, png_preset='default'):
+    """
+    Traverse the source directory to find .png files and create corresponding .vmat files in the target directory.
 
-                try:
-                    parts = relative_png_path.split('/tex/')
-                    if len(parts) > 1:
-                        subfolders = parts[1].rsplit('/', 1)[0]
-                        prefix = f"{subfolders.replace('/', '_')}_"
-                    else:
-                        prefix = ''
-                except IndexError:
-                    prefix = ''
+    The image work is spread over a process pool when more than one worker is requested. The .vmat files are
+    always written by the calling process in the sorted texture order, so when two textures map to the same
+    .vmat file name the first one wins and the output is the same for any number of workers.
 
-                if prefix.endswith('_'):
-                    prefix = prefix[:-1] + '-'
+    Processed textures are recorded in a build cache in the target directory, and textures that did not change
+    since the last run are skipped unless force is set.
 
-                vmat_filename = prefix + os.path.splitext(file)[0] + '.vmat'
+    With atlas set, the textures are packed into atlases instead, see create_atlases.
 
-                if vmat_filename.startswith("jmc2obj_banner_"):
-                    vmat_filename = vmat_filename.replace("jmc2obj_banner_", "jmc2obj_banner-banner_")
+    With dedupe set, textures with the same decoded pixels as an earlier texture are neither processed nor get a
+    .vmat file, see deduplicate_textures. The alias table material_aliases.json in the target directory maps the
+    material name of each duplicate to the material that replaces it.
 
-                if vmat_filename.startswith("minecraft_entity_"):
-                    vmat_filename = vmat_filename.replace("minecraft_entity_", "minecraft_entity-")
+    :param source_directory: The directory containing the .png files.
+    :param target_directory: The directory where the .vmat files will be created.
+    :param workers: The number of worker processes used for the image work.
+    :param force: Whether to ignore the build cache and process every texture again.
+    :param atlas: Whether to pack the textures into atlases with one .vmat file per atlas.
+    :param atlas_size: The maximum width and height of an atlas, a power of two.
+    :param atlas_padding: The number of pixels of bleed around each texture in an atlas.
+    :param dedupe: Whether to process textures with identical pixels only once.
+    :param png_preset: The name of a preset in png_encoding.PNG_PRESETS to save the .png files with.
+    """
+    params = get_preset_params(png_preset) or None
+    os.makedirs(target_directory, exist_ok=True)
+    cache = BuildCache.for_directory(target_directory, 'vmat', force)
+
+    textures = []
+    for full_png_path, trans_png_filepath, relative_png_path in find_textures(source_directory):
+        vmat_filepath = os.path.join(target_directory, get_vmat_filename(relative_png_path))
+        inputs = [full_png_path, trans_png_filepath]
+        if dedupe:
+            # Duplicates never get a _trans.png
+            inputs = [input_path for input_path in inputs if os.path.exists(input_path)]
+        # In atlas mode the per-texture .vmat files are not written, and in dedupe mode only for unique textures,
+        # so they cannot be required
+        is_fresh = cache.is_fresh('vmat', full_png_path, inputs, params,
+                                  outputs=[] if atlas or dedupe else [vmat_filepath])
+        textures.append((full_png_path, trans_png_filepath, relative_png_path, vmat_filepath, is_fresh))
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=disable_in_worker) if workers > 1 else None
+
+    atlas_textures = []
+    try:
+        if dedupe:
+            textures, aliases, pixel_hashes = deduplicate_textures(textures, cache, executor, params)
+
+        png_paths = [texture[0] for texture in textures if not texture[4]]
+        trans_paths = [texture[1] for texture in textures if not texture[4]]
+
+        if executor:
+            results = executor.map(timed_call, repeat(process_texture), png_paths, trans_paths, repeat(png_preset),
+                                   chunksize=16)
+        else:
+            results = map(timed_call, repeat(process_texture), png_paths, trans_paths, repeat(png_preset))
+
+        for full_png_path, trans_png_filepath, relative_png_path, vmat_filepath, is_fresh in textures:
+            if is_fresh:
+                metrics.log(f"Skipped {full_png_path} as it is unchanged")
+                metrics.count('unchanged')
+                if atlas:
+                    is_transparent = cache.get('vmat', full_png_path)['is_transparent']
+                    atlas_textures.append((full_png_path, trans_png_filepath, relative_png_path, vmat_filepath,
+                                           is_transparent))
+                elif dedupe and not os.path.exists(vmat_filepath):
+                    write_vmat_file(vmat_filepath, relative_png_path,
+                                    cache.get('vmat', full_png_path)['is_transparent'])
+                continue
+
+            seconds, (is_transparent, trans_created) = next(results)
+            metrics.count('decode')
+            metrics.count('encode', 2 if trans_created else 1)
+            metrics.file_done('vmat', full_png_path, seconds, transparent=is_transparent)
+            extra = {'rgb_hash': pixel_hashes[full_png_path]} if dedupe else {}
+            cache.record('vmat', full_png_path, [full_png_path, trans_png_filepath], params,
+                         is_transparent=is_transparent, **extra)
+            metrics.log(f"Translucency removed from {full_png_path}")
+            if trans_created:
+                metrics.log(f"Created {trans_png_filepath}")
+
+            if atlas:
+                atlas_textures.append((full_png_path, trans_png_filepath, relative_png_path, vmat_filepath,
+                                       is_transparent))
+            else:
+                write_vmat_file(vmat_filepath, relative_png_path, is_transparent)
 
-                vmat_filename = vmat_filename.replace("player_wide-steve", "player-wide-steve")
+        if dedupe:
+            aliases_path = os.path.join(target_directory, ALIASES_NAME)
+            with open(aliases_path, 'w') as aliases_file:
+                json.dump({'aliases': aliases}, aliases_file, indent=1, sort_keys=True)
+            print(f"Wrote {len(aliases)} material aliases to {aliases_path}")
 
-                vmat_filepath = os.path.join(target_directory, vmat_filename)
+        if atlas:
+            create_atlases(source_directory, target_directory, atlas_textures, cache, atlas_size, atlas_padding,
+                           aliases if dedupe else None, png_preset)
+    finally:
+        if executor:
+            executor.shutdown()
+        cache.save()
 
-                if not os.path.exists(vmat_filepath):
-                    vmat_content = generate_vmat_content(relative_png_path,
-                                                         relative_png_path.replace(".png", "_trans.png"),
-                                                         is_transparent)
-                    with open(vmat_filepath, 'w') as vmat_file:
-                        vmat_file.write(vmat_content)
-                        print(
-                            f"Generated {vmat_filepath} with {'transparency' if is_transparent else 'no transparency'}")
-                else:
-                    print(f"Skipped {vmat_filepath} as it already exists")
+
+def update_vmat_files(source_directory, target_directory, png_paths, png_preset='default'):
+    """
+    Process only the given textures, e.g. after they changed, and rewrite their _trans.png and .vmat files.
+
+    Unlike create_vmat_files, an existing _trans.png and .vmat file are replaced, because they were made from the
+    previous version of the texture. Textures whose state matches the build cache, such as textures this function
+    just rewrote, are skipped, and so are textures that no longer exist.
+
+    :param source_directory: The directory containing the .png files.
+    :param target_directory: The directory where the .vmat files will be created.
+    :param png_paths: The paths to the changed .png files below the source directory.
+    :param png_preset: The name of a preset in png_encoding.PNG_PRESETS to save the .png files with.
+    """
+    params = get_preset_params(png_preset) or None
+    os.makedirs(target_directory, exist_ok=True)
+    cache = BuildCache.for_directory(target_directory, 'vmat')
+    try:
+        for full_png_path in sorted(png_paths):
+            if not os.path.exists(full_png_path):
+                continue
+            relative_png_path = os.path.relpath(full_png_path, source_directory).replace('\\', '/')
+            trans_png_filepath = os.path.splitext(full_png_path)[0] + '_trans.png'
+            vmat_filepath = os.path.join(target_directory, get_vmat_filename(relative_png_path))
+            if cache.is_fresh('vmat', full_png_path, [full_png_path, trans_png_filepath], params,
+                              outputs=[vmat_filepath]):
+                continue
+
+            remove_texture_outputs(cache, full_png_path, trans_png_filepath, vmat_filepath)
+            seconds, (is_transparent, _) = timed_call(process_texture, full_png_path, trans_png_filepath, png_preset)
+            metrics.count('decode')
+            metrics.count('encode', 2)
+            metrics.file_done('vmat', full_png_path, seconds, transparent=is_transparent)
+            cache.record('vmat', full_png_path, [full_png_path, trans_png_filepath], params,
+                         is_transparent=is_transparent)
+            write_vmat_file(vmat_filepath, relative_png_path, is_transparent)
+            print(f"Updated {vmat_filepath}")
+    finally:
+        cache.save()
+
+
+def reset_changed_textures(source_directory, target_directory, png_paths, png_preset='default'):
+    """
+    Remove the _trans.png and .vmat files of the given textures that changed since the build cache recorded them,
+    and forget their entries, so that a following create_vmat_files processes them again. create_vmat_files keeps
+    existing _trans.png and .vmat files, so without this they would stay made from the previous version of the
+    texture. Used instead of update_vmat_files in atlas and dedupe mode, where the outputs depend on many textures.
+
+    :param source_directory: The directory containing the .png files.
+    :param target_directory: The directory where the .vmat files are created.
+    :param png_paths: The paths to the changed .png files below the source directory.
+    :param png_preset: The name of a preset in png_encoding.PNG_PRESETS the .png files are saved with.
+    :return: The paths of the textures that were reset.
+    """
+    params = get_preset_params(png_preset) or None
+    cache = BuildCache.for_directory(target_directory, 'vmat')
+    reset_paths = []
+    try:
+        for full_png_path in sorted(png_paths):
+            if not os.path.exists(full_png_path):
+                continue
+            entry = cache.get('vmat', full_png_path)
+            # Duplicates are recorded without a _trans.png, so check the inputs that were recorded
+            if entry is not None and cache.is_fresh('vmat', full_png_path, list(entry['inputs']), params):
+                continue
+            relative_png_path = os.path.relpath(full_png_path, source_directory).replace('\\', '/')
+            remove_texture_outputs(cache, full_png_path, os.path.splitext(full_png_path)[0] + '_trans.png',
+                                   os.path.join(target_directory, get_vmat_filename(relative_png_path)))
+            reset_paths.append(full_png_path)
+    finally:
+        cache.save()
+    return reset_paths
+
+
+def remove_texture_outputs(cache, full_png_path, trans_png_filepath, vmat_filepath):
+    """
+    Remove the _trans.png and .vmat file made from a previous version of a texture and forget its build cache entry.
+
+    :param cache: The build cache of the target directory.
+    :param full_png_path: The path to the .png file.
+    :param trans_png_filepath: The path to its _trans.png file.
+    :param vmat_filepath: The path to its .vmat file.
+    """
+    for stale_path in (trans_png_filepath, vmat_filepath):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    cache.forget('vmat', full_png_path)
+
+
+def hash_texture_pixels(png_path):
+    """
+    Hash the decoded pixels of a texture, so that textures with identical pixels get the same hash regardless of
+    how their files are encoded. The alpha band is left out, since processing makes every texture opaque and builds
+    the _trans.png from the color alone, so the hash of a texture is the same before and after processing.
+
+    :param png_path: The path to the .png file.
+    :return: The hex digest of the size and RGB pixels.
+    """
+    img = image_cache.load(png_path).convert("RGB")
+    digest = hashlib.sha256(f"{img.size[0]}x{img.size[1]}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def deduplicate_textures(textures, cache, executor=None, params=None):
+    """
+    Find the textures whose color pixels are identical to an earlier texture in the list. The first texture with
+    given pixels is the canonical one, and the materials of the others become aliases of its material.
+
+    The hash of each texture is taken from the build cache if the texture did not change since it was recorded, so
+    that unchanged textures are not decoded. Duplicates are recorded in the cache without being processed, and the
+    _trans.png and .vmat file a duplicate got while it was unique are removed.
+
+    :param textures: A list of (full_png_path, trans_png_filepath, relative_png_path, vmat_filepath, is_fresh)
+                     tuples.
+    :param cache: The build cache of the target directory.
+    :param executor: An optional executor to hash the textures with.
+    :param params: The parameters the textures are recorded with in the build cache.
+    :return: A (unique_textures, aliases, pixel_hashes) tuple, where unique_textures are the canonical textures
+             in the same form as textures, aliases maps the material name of each duplicate to the material name of
+             its canonical texture, and pixel_hashes maps the path of each texture to its hash.
+    """
+    pixel_hashes = {}
+    to_hash = []
+    for full_png_path, _, _, _, is_fresh in textures:
+        entry = cache.get('vmat', full_png_path)
+        if is_fresh and 'rgb_hash' in entry:
+            pixel_hashes[full_png_path] = entry['rgb_hash']
+        else:
+            to_hash.append(full_png_path)
+    metrics.count('decode', len(to_hash))
+    if executor:
+        pixel_hashes.update(zip(to_hash, executor.map(hash_texture_pixels, to_hash, chunksize=16)))
+    else:
+        pixel_hashes.update(zip(to_hash, map(hash_texture_pixels, to_hash)))
+
+    canonical = {}  # Pixel hash to the material name of its canonical texture
+    unique_textures = []
+    duplicates = []
+    aliases = {}
+    for texture in textures:
+        full_png_path, trans_png_filepath, _, vmat_filepath, is_fresh = texture
+        pixel_hash = pixel_hashes[full_png_path]
+        material = os.path.splitext(os.path.basename(vmat_filepath))[0]
+        if pixel_hash not in canonical:
+            canonical[pixel_hash] = material
+            if is_fresh and cache.get('vmat', full_png_path).get('is_transparent') is None:
+                # A former duplicate that became canonical was never processed
+                texture = texture[:4] + (False,)
+            unique_textures.append(texture)
+            continue
+
+        if canonical[pixel_hash] != material:
+            aliases[material] = canonical[pixel_hash]
+        duplicates.append((full_png_path, trans_png_filepath, vmat_filepath, material, pixel_hash, is_fresh))
+        metrics.log(f"Skipped {full_png_path} as it is a duplicate of {canonical[pixel_hash]}")
+        metrics.count('duplicate')
+
+    # A .vmat file of the same name as a canonical material belongs to that material
+    canonical_materials = set(canonical.values())
+    for full_png_path, trans_png_filepath, vmat_filepath, material, pixel_hash, is_fresh in duplicates:
+        stale_paths = [trans_png_filepath] + ([vmat_filepath] if material not in canonical_materials else [])
+        removed = False
+        for stale_path in stale_paths:
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+                metrics.log(f"Removed {stale_path} of duplicate {full_png_path}")
+                removed = True
+        if removed or not is_fresh:
+            cache.record('vmat', full_png_path, [full_png_path], params, is_transparent=None, rgb_hash=pixel_hash)
+    return unique_textures, aliases, pixel_hashes
+
+
+def write_vmat_file(vmat_filepath, relative_png_path, is_transparent):
+    """
+    Write the .vmat file of a texture, unless it already exists.
+
+    :param vmat_filepath: The path to the .vmat file.
+    :param relative_png_path: The relative path to the .png file from the root directory.
+    :param is_transparent: Whether the vmat should include transparency.
+    """
+    if not os.path.exists(vmat_filepath):
+        vmat_content = generate_vmat_content(relative_png_path,
+                                             relative_png_path.replace(".png", "_trans.png"),
+                                             is_transparent)
+        with open(vmat_filepath, 'w') as vmat_file:
+            vmat_file.write(vmat_content)
+            metrics.log(
+                f"Generated {vmat_filepath} with {'transparency' if is_transparent else 'no transparency'}")
+        metrics.count('write', size=len(vmat_content.encode()))
+    else:
+        metrics.log(f"Skipped {vmat_filepath} as it already exists")
+
+
+def create_atlases(source_directory, target_directory, textures, cache, atlas_size=4096, atlas_padding=2,
+                   aliases=None, png_preset='default'):
+    """
+    Pack textures into power-of-two atlases, one set of atlases per transparency class, and write one .vmat file
+    per atlas instead of one per texture.
+
+    The atlas images are written to the _atlas folder of the source directory, the translucent atlases together
+    with a _trans.png atlas of the same layout. Each texture is surrounded by atlas_padding pixels repeating its
+    edge pixels, so that filtering does not bleed neighbouring textures into it. Textures too large for an atlas
+    keep their own .vmat file.
+
+    The UV remap table atlas_uv_remap.json in the target directory maps the name of each texture's material to
+    the material that replaces it and to the rectangle of the texture in the atlas, in pixels and in UV
+    coordinates with v measured from the top. Mesh tools remap a UV inside [0, 1] to
+    (u_min + u * (u_max - u_min), v_min + v * (v_max - v_min)). UVs tiling a texture more than once cannot be
+    remapped this way.
+
+    Atlases whose textures and layout did not change since the last run are not rebuilt.
+
+    :param source_directory: The directory containing the .png files.
+    :param target_directory: The directory where the .vmat files will be created.
+    :param textures: A list of (full_png_path, trans_png_filepath, relative_png_path, vmat_filepath,
+                     is_transparent) tuples.
+    :param cache: The build cache of the target directory.
+    :param atlas_size: The maximum width and height of an atlas, a power of two.
+    :param atlas_padding: The number of pixels of bleed around each texture.
+    :param aliases: An optional dict mapping material names to the material names whose remap entry they share.
+    :param png_preset: The name of a preset in png_encoding.PNG_PRESETS to save the atlases with.
+    """
+    remap = {}
+    classes = {False: [], True: []}
+    for full_png_path, trans_png_filepath, relative_png_path, vmat_filepath, is_transparent in textures:
+        material = os.path.splitext(os.path.basename(vmat_filepath))[0]
+        if material in remap:
+            continue  # The first texture mapping to a material name wins, as without atlases
+        with Image.open(full_png_path) as img:
+            size = img.size
+        if max(size) + 2 * atlas_padding > atlas_size:
+            write_vmat_file(vmat_filepath, relative_png_path, is_transparent)
+            remap[material] = {'material': material, 'atlas': None, 'rect': [0, 0, *size], 'uv': [0.0, 0.0, 1.0, 1.0]}
+            continue
+        remap[material] = None
+        classes[is_transparent].append((material, full_png_path, trans_png_filepath, size))
+
+    atlas_directory = os.path.join(source_directory, ATLAS_DIRECTORY)
+    os.makedirs(atlas_directory, exist_ok=True)
+
+    for is_transparent, members in classes.items():
+        class_name = 'translucent' if is_transparent else 'opaque'
+        packed = pack_rectangles([size for _, _, _, size in members], atlas_size, atlas_padding)
+        for atlas_index, (size, placements) in enumerate(packed):
+            name = f"atlas_{class_name}_{atlas_index}"
+            atlas_members = [(members[index], position) for index, position in sorted(placements.items())]
+            png_path = os.path.join(atlas_directory, name + '.png')
+            trans_path = os.path.join(atlas_directory, name + '_trans.png')
+            vmat_filepath = os.path.join(target_directory, name + '.vmat')
+
+            inputs = [member[1] for member, _ in atlas_members]
+            outputs = [png_path, vmat_filepath]
+            if is_transparent:
+                inputs += [member[2] for member, _ in atlas_members]
+                outputs.append(trans_path)
+            params = {'size': size, 'padding': atlas_padding, 'png_preset': png_preset,
+                      'layout': [[member[0], *position] for member, position in atlas_members]}
+
+            if cache.is_fresh('atlas', name, inputs, params, outputs):
+                metrics.log(f"Skipped {png_path} as it is unchanged")
+            else:
+                positions = [position for _, position in atlas_members]
+                save_png(build_atlas_image([member[1] for member, _ in atlas_members], positions, size,
+                                           atlas_padding), png_path, png_preset, cache=False)
+                if is_transparent:
+                    save_png(build_atlas_image([member[2] for member, _ in atlas_members], positions, size,
+                                               atlas_padding), trans_path, png_preset, cache=False)
+                metrics.count('decode', len(inputs))
+                metrics.count('encode', 2 if is_transparent else 1)
+                print(f"Packed {len(atlas_members)} textures into {png_path} ({size[0]}x{size[1]})")
+
+                relative_png_path = f"{ATLAS_DIRECTORY}/{name}.png"
+                write_vmat_file(vmat_filepath, relative_png_path, is_transparent)
+                cache.record('atlas', name, inputs, params)
+
+            for (material, _, _, texture_size), position in atlas_members:
+                remap[material] = {'material': name, 'atlas': f"{ATLAS_DIRECTORY}/{name}.png",
+                                   'rect': [*position, *texture_size],
+                                   'uv': get_uv_rect(position, texture_size, size)}
+
+    for alias, material in (aliases or {}).items():
+        remap[alias] = remap[material]
+
+    remap_path = os.path.join(target_directory, UV_REMAP_NAME)
+    with open(remap_path, 'w') as remap_file:
+        json.dump({'padding': atlas_padding, 'materials': remap}, remap_file, indent=1, sort_keys=True)
+    print(f"Wrote the UV remap table of {len(remap)} materials to {remap_path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create .vmat files for all .png files in a directory.")
+    parser.add_argument("source_directory", help="The directory containing the .png files.")
+    parser.add_argument("target_directory", help="The directory where the .vmat files will be created.")
+    parser.add_argument("--workers", type=int, default=1, help="The number of worker processes for the image work.")
+    parser.add_argument("--force", action="store_true", help="Ignore the build cache and process every texture.")
+    parser.add_argument("--atlas", action="store_true", help="Pack the textures into atlases.")
+    parser.add_argument("--atlas-size", type=int, default=4096, help="The maximum width and height of an atlas.")
+    parser.add_argument("--atlas-padding", type=int, default=2, help="The bleed around each texture in pixels.")
+    parser.add_argument("--dedupe", action="store_true", help="Process textures with identical pixels only once.")
+    parser.add_argument("--png-preset", choices=list(PNG_PRESETS), default='default',
+                        help="The PNG encoder settings, 'fast' for iteration or 'small' for release.")
+    parser.add_argument("--verbose", action="store_true", help="Print a message for every file.")
+    parser.add_argument("--events", help="A file to write the JSON lines event stream to.")
+    args = parser.parse_args()
+
+    metrics.configure(verbose=args.verbose, events_path=args.events)
+
+    create_vmat_files(args.source_directory, args.target_directory, workers=args.workers, force=args.force,
+                      atlas=args.atlas, atlas_size=args.atlas_size, atlas_padding=args.atlas_padding,
+                      dedupe=args.dedupe, png_preset=args.png_preset)
+    print(metrics.summary())
+    metrics.close()
@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from metrics import metrics
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    """
+    Finds changed files by scanning the watched trees and comparing the size and modification time of every file
+    with an index kept in memory. Works everywhere, but every scan touches every file.
+    """
+
+    def __init__(self, roots, interval=1.0):
+        self.roots = roots
+        self.interval = interval
+        self._index = self._scan()
+
+    def _scan(self):
+        index = {}
+        for root in self.roots:
+            for directory, _, files in os.walk(root):
+                for file in files:
+                    path = os.path.join(directory, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    index[path] = (stat.st_size, stat.st_mtime_ns)
+        return index
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for changes.
+
+        :return: The set of added, changed and removed file paths, empty if nothing changed.
+        """
+        time.sleep(min(timeout, self.interval))
+        index = self._scan()
+        changed = {path for path, state in index.items() if self._index.get(path) != state}
+        changed.update(path for path in self._index if path not in index)
+        self._index = index
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Finds changed files from the inotify events of every directory of the watched trees, which costs nothing while
+    nothing changes. Only available on Linux.
+    """
+
+    def __init__(self, roots):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}  # Watch descriptor to directory path
+        for root in roots:
+            self._add_tree(root)
+
+    def _add_tree(self, root, changed=None):
+        # New directories may already contain files by the time they are watched, so report those as changed
+        for directory, _, files in os.walk(root):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Cannot watch {directory}, the limit in "
+                                                  f"/proc/sys/fs/inotify/max_user_watches may be too low")
+            self._directories[wd] = directory
+            if changed is not None:
+                changed.update(os.path.join(directory, file) for file in files)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for changes.
+
+        :return: The set of added, changed and removed file paths, empty if nothing changed, or None if events were
+                 lost and everything has to be checked.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self._directories.pop(wd, None)
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_tree(path, changed)
+                else:
+                    changed.add(path)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create_watcher(roots, polling=False, interval=1.0):
+    """
+    Create an inotify watcher on Linux, or a polling watcher elsewhere, when inotify is not available or when
+    polling is requested, e.g. for network drives that do not report changes.
+
+    :param roots: The directories to watch, including their subdirectories.
+    :param polling: Whether to always poll.
+    :param interval: The time between two scans of the polling watcher in seconds.
+    """
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            print(f"Falling back to polling, inotify is not available: {e}")
+    return PollingWatcher(roots, interval)
+
+
+def watch_changes(watcher, handler, debounce=0.5, stop=None):
+    """
+    Call handler with batches of changed files until stop is set or the watch is interrupted. A batch is handed
+    over once no further change arrived for debounce seconds, so that a burst of writes, e.g. an editor saving or
+    a resource pack being unpacked, is handled at once.
+
+    :param watcher: A PollingWatcher or InotifyWatcher.
+    :param handler: A function taking the set of changed paths, or None if everything has to be checked.
+    :param debounce: The quiet time in seconds that ends a batch.
+    :param stop: An optional threading.Event that ends the watch.
+    """
+    while stop is None or not stop.is_set():
+        changed = watcher.wait(1.0)
+        if changed == set():
+            continue
+        while changed is not None:
+            more = watcher.wait(debounce)
+            if more == set():
+                break
+            changed = None if more is None else changed | more
+        handler(changed)
+
+
+class WatchedPipeline:
+    """
+    Maps changed files to the outputs that depend on them and updates only those, for the vmat, pbr and vmdl
+    stages of a pipeline config:
+
+    - a changed .png below the vmat source directory updates its _trans.png and .vmat file,
+    - a changed *_set.json, or a texture a texture set was built from, updates that texture set,
+    - an added, changed or removed .fbx file updates the models of the folders containing it.
+
+    Files the stages write themselves either match the build caches afterwards or are not inputs of any stage, so
+    they do not cause further updates. When the watcher lost events, the configured stages are run in full, which
+    their build caches keep cheap.
+    """
+
+    def __init__(self, stages):
+        self.stages = {name: options for name, options in stages.items() if name in ('vmat', 'pbr', 'vmdl')}
+
+    def get_roots(self):
+        roots = {'vmat': 'source_directory', 'pbr': 'input_dir', 'vmdl': 'directory'}
+        return sorted({self.stages[name][key] for name, key in roots.items() if name in self.stages})
+
+    def handle(self, changed):
+        metrics.event('watch_batch', changes=None if changed is None else len(changed))
+        if changed is None:
+            print("Changes were lost, checking everything")
+            self._run_all()
+            return
+        metrics.log(f"Handling {len(changed)} changed files")
+        for name, update in (('vmat', self._update_vmat), ('pbr', self._update_pbr), ('vmdl', self._update_vmdl)):
+            if name in self.stages:
+                try:
+                    with metrics.stage(f"watch {name}"):
+                        update(self.stages[name], changed)
+                except Exception as e:
+                    print(f"Updating stage {name} failed: {e}")
+
+    def _run_all(self):
+        from pipeline import run_stage
+        for name, options in self.stages.items():
+            try:
+                run_stage(name, options)
+            except Exception as e:
+                print(f"Stage {name} failed: {e}")
+
+    @staticmethod
+    def _below(root, paths, suffix):
+        # Rebuild the paths from the root as the stages do, so that they match the keys of their build caches
+        result = []
+        for path in paths:
+            relative_path = os.path.relpath(path, root)
+            if relative_path.split(os.sep)[0] != os.pardir and path.lower().endswith(suffix):
+                result.append(os.path.join(root, relative_path))
+        return result
+
+    def _update_vmat(self, options, changed):
+        from vmat_writer import ATLAS_DIRECTORY, create_vmat_files, reset_changed_textures, update_vmat_files
+        source_directory = options['source_directory']
+        png_paths = [path for path in self._below(source_directory, changed, '.png')
+                     if not path.lower().endswith('_trans.png')
+                     and os.path.relpath(path, source_directory).split(os.sep)[0] != ATLAS_DIRECTORY]
+        if not png_paths:
+            return
+        if options.get('atlas') or options.get('dedupe'):
+            # Atlases and duplicates depend on many textures, so let the build cache find what to redo once the
+            # outputs of the changed textures are gone
+            reset_changed_textures(source_directory, options['target_directory'], png_paths,
+                                   options.get('png_preset', 'default'))
+            create_vmat_files(**{key: value for key, value in options.items() if key != 'depends_on'})
+        else:
+            update_vmat_files(source_directory, options['target_directory'], png_paths,
+                              options.get('png_preset', 'default'))
+
+    def _update_pbr(self, options, changed):
+        from pbr_texture_creator import TextureSetFinder
+        input_dir = options['input_dir']
+        changed_below = self._below(input_dir, changed, '')
+        if not changed_below:
+            return
+        finder = TextureSetFinder(**{key: value for key, value in options.items() if key != 'depends_on'})
+        json_paths = {path for path in changed_below if path.endswith('_set.json')}
+        json_paths |= finder.get_dependent_texture_sets(changed_below)
+        if json_paths:
+            finder.update_texture_sets(json_paths)
+
+    def _update_vmdl(self, options, changed):
+        from model_writer import update_models
+        fbx_paths = self._below(options['directory'], changed, '.fbx')
+        if fbx_paths:
+            update_models(options['directory'], fbx_paths, options.get('addon_directory'))
+
+
+def run_watch(stages, polling=False, interval=1.0, debounce=0.5, stop=None):
+    """
+    Watch the source trees of the vmat, pbr and vmdl stages and update the outputs depending on each changed file
+    until interrupted. See WatchedPipeline.
+
+    :param stages: A dict mapping stage names to their options, as loaded by pipeline.load_config.
+    :param polling: Whether to poll instead of using inotify.
+    :param interval: The time between two scans when polling, in seconds.
+    :param debounce: The quiet time in seconds after which a batch of changes is handled.
+    :param stop: An optional threading.Event that ends the watch.
+    """
+    pipeline = WatchedPipeline(stages)
+    roots = pipeline.get_roots()
+    if not roots:
+        raise ValueError("None of the watchable stages vmat, pbr and vmdl is configured.")
+    watcher = create_watcher(roots, polling, interval)
+    print(f"Watching {', '.join(roots)} with {type(watcher).__name__}, press Ctrl+C to stop")
+    try:
+        watch_changes(watcher, pipeline.handle, debounce, stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()